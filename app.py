@@ -1,17 +1,73 @@
+import csv
+import io
+import json
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (Flask, Response, request, abort, jsonify,
+                   stream_with_context)
 from flask_cors import CORS
-import random
-from auth import AuthError, requires_auth
-from models import setup_db, Question, Category
+from werkzeug.middleware.proxy_fix import ProxyFix
+from auth import AuthError, PROXY_FIX_X_FOR, key_store, requires_auth
+from caching import category_catalog, conditional
+from compression import init_compression
+from metrics import init_metrics
+from models import (db, setup_db, format_rows, read_replica, Question,
+                    QuizSession, QUESTION_FIELDS, QUIZ_SESSION_TTL)
+from profiling import init_profiling
+from search import search_questions, SEARCH_MODES
+from serialization import dumps, json_response
 
 QUESTIONS_PER_PAGE = 10
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1000))
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/ndjson")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+
+"""
+Pagination is done by the database, only the requested page is loaded.
+By default pages are selected with LIMIT/OFFSET using the page argument,
+when after_id is given the page starts right after that question id
+(keyset pagination), which costs the same for any page depth.
+"""
+
+
+def paginate_response(page, query, after_id=None, limit=QUESTIONS_PER_PAGE):
+    query = query.order_by(Question.id)
+    if after_id is not None:
+        query = query.filter(Question.id > after_id)
+    elif page < 1:
+        return []
+    else:
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+    return format_rows(query.limit(limit))
+
+
+"""
+paginate_after(query, after_id)
+    the page of questions following after_id, and the after_id of the page
+    after it (None on the last page); one more question than a page is read
+    to tell whether there is one
+"""
+
+
+def paginate_after(query, after_id):
+    questions = paginate_response(
+        None, query, after_id, QUESTIONS_PER_PAGE + 1
+    )
+    if len(questions) <= QUESTIONS_PER_PAGE:
+        return questions, None
+    questions = questions[:QUESTIONS_PER_PAGE]
+    return questions, questions[-1]["id"]
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if PROXY_FIX_X_FOR:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
     setup_db(app)
+    init_metrics(app)
+    init_profiling(app)
+    init_compression(app)
 
     """
   Set up CORS. Allow '*' for origins.
@@ -78,15 +134,21 @@ def create_app(test_config=None):
   """
 
     @app.route("/categories")
+    @read_replica
     @requires_auth("get:categories")
+    @conditional("categories", "questions")
     def get_categories(jwt):
-        categories = Category.query.all()
-        categories = {category.id: category.type for category in categories}
+        categories = category_catalog.types()
+        counts = category_catalog.counts()
         return jsonify(
             {
                 "success": True,
                 "categories": categories,
                 "total_categories": len(categories),
+                "question_counts": {
+                    id: counts.get(id, 0) for id in categories
+                },
+                "total_questions": sum(counts.values()),
             }
         )
 
@@ -98,34 +160,47 @@ def create_app(test_config=None):
   number of total questions, current category, categories.
   """
 
-    def paginate_response(page, questions):
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-        questions = [question.format() for question in questions]
-        current_question = questions[start:end]
-        return current_question
+    """
+    Categories are referenced by id, a category is valid when it's an integer
+    (or an integer string) of an existing category
+    """
+
+    def valid_category(category):
+        try:
+            category = int(category)
+        except (TypeError, ValueError):
+            return None
+        if not category_catalog.exists(category):
+            return None
+        return category
 
     @app.route("/questions")
+    @read_replica
     @requires_auth("get:questions")
+    @conditional("questions", "categories")
     def get_questions(jwt):
         page = request.args.get("page", 1, int)
-        questions = Question.query.all()
-        total_questions = len(questions)
-        questions = paginate_response(page, questions)
+        after_id = request.args.get("after_id", None, int)
+        query = Question.select_rows()
+        if after_id is None:
+            questions = paginate_response(page, query)
+        else:
+            questions, next_after_id = paginate_after(query, after_id)
         if not questions:
             abort(404)
-        categories = Category.query.all()
-        categories = {category.id: category.type for category in categories}
-        return jsonify(
-            {
-                "success": True,
-                "questions": questions,
-                "page": page,
-                "total_questions": total_questions,
-                "categories": categories,
-                "current_category": "Null",
-            }
-        )
+        total_questions = sum(category_catalog.counts().values())
+        categories = category_catalog.types()
+        response = {
+            "success": True,
+            "questions": questions,
+            "page": page,
+            "total_questions": total_questions,
+            "categories": categories,
+            "current_category": "Null",
+        }
+        if after_id is not None:
+            response["next_after_id"] = next_after_id
+        return json_response(response)
 
     """TEST: At this point, when you start the application
   you should see questions and categories generated,
@@ -170,6 +245,9 @@ def create_app(test_config=None):
         difficulty = payload.get("difficulty", "")
         if not (question and answer and category and difficulty):
             abort(422)
+        category = valid_category(category)
+        if not category:
+            abort(422)
         new_question = Question(
             question=question,
             answer=answer,
@@ -181,6 +259,144 @@ def create_app(test_config=None):
         return jsonify({"success": True, "question_id": question_id})
 
     """
+    Bulk import of questions.
+    The body is either a JSON array of questions or NDJSON (one question per
+    line, Content-Type: application/x-ndjson), which is read as a stream.
+    Each question has the same fields as in POST /questions. Invalid rows
+    are reported by their (1-based) position and skipped, valid rows are
+    written in batches of BULK_BATCH_SIZE.
+    """
+
+    def bulk_rows():
+        if request.mimetype in NDJSON_MIMETYPES:
+            for row_number, line in enumerate(request.stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield row_number, json.loads(line)
+                except ValueError:
+                    yield row_number, None
+        else:
+            payload = request.get_json(silent=True)
+            if not isinstance(payload, list):
+                abort(422)
+            for row_number, row in enumerate(payload, 1):
+                yield row_number, row
+
+    def validate_bulk_row(row, category_ids):
+        if not isinstance(row, dict):
+            return None, "Invalid JSON object"
+        question = row.get("question", "")
+        answer = row.get("answer", "")
+        if not (question and isinstance(question, str)):
+            return None, "question is required"
+        if not (answer and isinstance(answer, str)):
+            return None, "answer is required"
+        try:
+            category = int(row.get("category", ""))
+        except (TypeError, ValueError):
+            category = None
+        if category not in category_ids:
+            return None, "category is not a valid category id"
+        try:
+            difficulty = int(row.get("difficulty", ""))
+        except (TypeError, ValueError):
+            return None, "difficulty must be an integer"
+        return {
+            "question": question,
+            "answer": answer,
+            "category": category,
+            "difficulty": difficulty,
+        }, None
+
+    @app.route("/questions/bulk", methods=["POST"])
+    @requires_auth("create:questions")
+    def bulk_create_questions(jwt):
+        category_ids = category_catalog.types()
+        question_ids = []
+        errors = []
+        batch = []
+        for row_number, row in bulk_rows():
+            new_question, error = validate_bulk_row(row, category_ids)
+            if error:
+                errors.append({"row": row_number, "message": error})
+                continue
+            batch.append(new_question)
+            if len(batch) >= BULK_BATCH_SIZE:
+                question_ids.extend(Question.bulk_insert(batch))
+                batch = []
+        question_ids.extend(Question.bulk_insert(batch))
+        return jsonify(
+            {
+                "success": True,
+                "question_ids": question_ids,
+                "total_created": len(question_ids),
+                "errors": errors,
+            }
+        )
+
+    """
+    Export of the question bank, streamed as NDJSON (default) or CSV.
+    Rows are read from a server-side cursor EXPORT_BATCH_SIZE at a time
+    and written out as they are read, so memory use doesn't depend on the
+    size of the bank. Can be filtered by category.
+    """
+
+    def export_ndjson(rows):
+        lines = []
+        for row in rows:
+            lines.append(dumps(dict(zip(QUESTION_FIELDS, row))))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+
+    def export_csv(rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(QUESTION_FIELDS)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    @app.route("/questions/export")
+    @read_replica
+    @requires_auth("get:questions")
+    def export_questions(jwt):
+        export_format = request.args.get("format", "ndjson")
+        category = request.args.get("category", None)
+        if export_format not in ("ndjson", "csv"):
+            abort(422)
+        query = Question.select_rows()
+        if category is not None:
+            category = valid_category(category)
+            if not category:
+                abort(404)
+            query = query.filter(Question.category == category)
+        rows = (
+            query.order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(EXPORT_BATCH_SIZE)
+        )
+        if export_format == "csv":
+            body, mimetype = export_csv(rows), "text/csv"
+        else:
+            body, mimetype = export_ndjson(rows), "application/x-ndjson"
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={
+                "Content-Disposition":
+                    f"attachment; filename=questions.{export_format}"
+            },
+        )
+
+    """
   @TODO:
   Create an endpoint to PATCH an existing question,
   which will require the question ID and allows to edit
@@ -207,6 +423,9 @@ def create_app(test_config=None):
         if answer:
             edit_question.answer = answer
         if category:
+            category = valid_category(category)
+            if not category:
+                abort(422)
             edit_question.category = category
         if difficulty:
             edit_question.difficulty = difficulty
@@ -226,23 +445,26 @@ def create_app(test_config=None):
   """
 
     @app.route("/questions/search", methods=["POST"])
+    @read_replica
     @requires_auth("get:questions")
     def search_question(jwt):
         payload = request.get_json()
         search_term = payload.get("searchTerm", "")
-        if not search_term:
+        page = payload.get("page", 1)
+        mode = payload.get("mode", "substring")
+        if not search_term or not isinstance(page, int):
             abort(422)
-        questions = [
-            question.format()
-            for question in Question.query.filter(
-                Question.question.ilike("%" + search_term + "%")
-            ).all()
-        ]
-        return jsonify(
+        if mode not in SEARCH_MODES:
+            abort(422)
+        questions, total_questions = search_questions(
+            search_term, page, QUESTIONS_PER_PAGE, mode
+        )
+        return json_response(
             {
                 "success": True,
-                "total_questions": len(questions),
-                "questions": questions,
+                "total_questions": total_questions,
+                "questions": format_rows(questions),
+                "page": page,
                 "current_category": "Null",
             }
         )
@@ -259,27 +481,32 @@ def create_app(test_config=None):
   """
 
     @app.route("/categories/<int:category_id>/questions")
+    @read_replica
     @requires_auth("get:questions")
-    def get_questions_by_category(jwt, category_id, paginate=True):
+    @conditional("questions", "categories")
+    def get_questions_by_category(jwt, category_id):
         page = request.args.get("page", 1, int)
-        category = Category.query.filter_by(id=category_id).first()
-        if not category:
+        after_id = request.args.get("after_id", None, int)
+        if not category_catalog.exists(category_id):
             abort(404)
-        questions = Question.query.filter_by(category=str(category.id)).all()
-        total_questions = len(questions)
-        if paginate:
-            questions = paginate_response(page, questions)
-        else:
-            return [question.format() for question in questions]
-        return jsonify(
-            {
-                "success": True,
-                "questions": questions,
-                "page": page,
-                "total_questions": total_questions,
-                "current_category": category_id,
-            }
+        query = Question.select_rows().filter(
+            Question.category == category_id
         )
+        if after_id is None:
+            questions = paginate_response(page, query)
+        else:
+            questions, next_after_id = paginate_after(query, after_id)
+        total_questions = category_catalog.counts().get(category_id, 0)
+        response = {
+            "success": True,
+            "questions": questions,
+            "page": page,
+            "total_questions": total_questions,
+            "current_category": category_id,
+        }
+        if after_id is not None:
+            response["next_after_id"] = next_after_id
+        return json_response(response)
 
     """
   TEST: In the "List" tab / main screen, clicking on one of the
@@ -296,26 +523,73 @@ def create_app(test_config=None):
   """
 
     @app.route("/quizzes", methods=["POST"])
+    @read_replica
     @requires_auth("get:quizzes")
     def quizzes(jwt):
         payload = request.get_json()
         previous_questions = payload.get("previous_questions", [])
-        category = payload.get("quiz_category", "").get("id", "")
+        if not isinstance(previous_questions, list) or not all(
+            isinstance(id, int) and not isinstance(id, bool)
+            for id in previous_questions
+        ):
+            abort(422)
+        category = (payload.get("quiz_category") or {}).get("id", "")
         if category:
-            questions = get_questions_by_category(category, paginate=False)
-        else:
-            questions = [
-                question.format() for question in Question.query.all()
-            ]
-        if previous_questions:
-            questions = [
-                question
-                for question in questions
-                if question["id"] not in previous_questions
-            ]
-        random_question = random.choice(questions) if questions else False
+            category = valid_category(category)
+            if not category:
+                abort(404)
+        question = Question.pick_random(category, previous_questions)
+        random_question = question.format() if question else False
         return jsonify({"success": True, "question": random_question})
 
+    """
+  Quiz sessions keep the questions already asked server-side, so the client
+  doesn't send them with every turn. POST /quizzes/sessions takes the same
+  quiz_category as /quizzes and returns the id of the new session, each
+  POST /quizzes/sessions/<session_id>/next returns a question not asked
+  yet in the session (False when there are none left). Sessions belong to
+  the subject of the token that created them.
+  """
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    @requires_auth("get:quizzes")
+    def start_quiz_session(jwt):
+        payload = request.get_json(silent=True) or {}
+        category = (payload.get("quiz_category") or {}).get("id", "")
+        if category:
+            category = valid_category(category)
+            if not category:
+                abort(404)
+        session = QuizSession.start(jwt.get("sub"), category or None)
+        return jsonify(
+            {
+                "success": True,
+                "session_id": session.id,
+                "quiz_category": session.category,
+                "expires_in": QUIZ_SESSION_TTL,
+            }
+        )
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    @requires_auth("get:quizzes")
+    def next_quiz_question(jwt, session_id):
+        session = QuizSession.find(session_id, jwt.get("sub"))
+        if session is None:
+            abort(404)
+        counts = category_catalog.counts()
+        if session.category:
+            total = counts.get(session.category, 0)
+        else:
+            total = sum(counts.values())
+        question, played = session.next_question(total)
+        return jsonify(
+            {
+                "success": True,
+                "question": question.format() if question else False,
+                "questions_played": played,
+            }
+        )
+
     """
   TEST: In the "Play" tab, after a user selects "All" or a category,
   one question at a time is displayed, the user is allowed to answer
@@ -400,9 +674,31 @@ def create_app(test_config=None):
                 }
             ),
             error_status_code,
+            error.headers or {},
         )
 
     return app
 
 
+"""
+warm_up(app)
+    loads the signing keys and the categories cache, so the first
+    requests don't pay for it; called once before accepting traffic
+    (see gunicorn.conf.py)
+"""
+
+
+def warm_up(app):
+    try:
+        key_store.refresh()
+    except AuthError:
+        app.logger.warning(
+            "Unable to load the signing keys, will retry on demand"
+        )
+    with app.app_context():
+        category_catalog.types()
+        category_catalog.counts()
+        db.session.remove()
+
+
 app = create_app()
@@ -0,0 +1,24 @@
+"""
+ASGI entry point, for ASGI servers:
+
+    uvicorn asgi:app
+
+    uvicorn asgi:app --workers 4
+
+Serves the same Flask app as app:app (same routes and error handlers)
+through asgiref's WSGI adapter. The app stays synchronous: each request
+holds a thread of asgiref's pool until it's done, so a process serves at
+most ASGI_THREADS requests at once (default min(32, CPUs + 4)), however
+many connections the server accepts. This relies on asgiref 3.2 as pinned
+in requirements.txt, later versions run all the requests of a process on
+a single thread.
+
+ASGI doesn't make the app non-blocking. For many concurrent clients per
+process (i.e. quiz players waiting on Auth0 and the database) use the
+gevent worker instead, see gunicorn.conf.py.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as wsgi_app
+
+app = WsgiToAsgi(wsgi_app)
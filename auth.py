@@ -1,14 +1,57 @@
+import hashlib
 import json
+import math
 import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from flask import (request,
                    abort)
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from jose.exceptions import JWKError
 from urllib.request import urlopen
+from metrics import observe_auth
+from profiling import record_timing
 
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 ALGORITHMS = os.getenv("ALGORITHMS")
+ALLOWED_ALGORITHMS = re.findall(r"[A-Z]{2}\d{3}", ALGORITHMS or "RS256")
 API_AUDIENCE = os.getenv("API_AUDIENCE")
+JWKS_URL = os.getenv(
+    "JWKS_URL", f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+)
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", 3600))
+JWKS_MAX_TTL = int(os.getenv("JWKS_MAX_TTL", 86400))
+JWKS_REFRESH_AHEAD = int(os.getenv("JWKS_REFRESH_AHEAD", 300))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 30))
+JWKS_FETCH_TIMEOUT = float(os.getenv("JWKS_FETCH_TIMEOUT", 5))
+JWKS_FILE = os.getenv("JWKS_FILE")
+JWKS_FILE_CHECK_INTERVAL = float(os.getenv("JWKS_FILE_CHECK_INTERVAL", 1))
+AUTH_PUBLIC_KEY = os.getenv("AUTH_PUBLIC_KEY")
+AUTH_PUBLIC_KEY_KID = os.getenv("AUTH_PUBLIC_KEY_KID")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+TOKEN_CACHE_MAX_AGE = int(os.getenv("TOKEN_CACHE_MAX_AGE", 300))
+REJECTED_TOKEN_CACHE_SIZE = int(os.getenv("REJECTED_TOKEN_CACHE_SIZE", 4096))
+REJECTED_TOKEN_TTL = int(os.getenv("REJECTED_TOKEN_TTL", 30))
+# Number of reverse proxies (i.e. the Heroku router) in front of the app,
+# the client address is only trusted when it's set (see create_app)
+PROXY_FIX_X_FOR = int(os.getenv("PROXY_FIX_X_FOR", 0))
+# Without a trusted client address, every client behind the router (or a
+# NAT) would share one failure counter, so the limit is off
+AUTH_FAILURE_LIMIT = (
+    int(os.getenv("AUTH_FAILURE_LIMIT", 20)) if PROXY_FIX_X_FOR else 0
+)
+AUTH_FAILURE_WINDOW = int(os.getenv("AUTH_FAILURE_WINDOW", 60))
+RATE_LIMIT_PER_SUBJECT = os.getenv("RATE_LIMIT_PER_SUBJECT")
+RATE_LIMIT_PER_PERMISSION = os.getenv("RATE_LIMIT_PER_PERMISSION", "")
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB")
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 0))
+MAX_QUEUE_TIME = int(os.getenv("MAX_QUEUE_TIME", 0))
 
 """
 AuthError Exception
@@ -17,9 +60,668 @@ A standardized way to communicate auth failure modes
 
 
 class AuthError(Exception):
-    def __init__(self, error, status_code):
+    def __init__(self, error, status_code, headers=None):
         self.error = error
         self.status_code = status_code
+        self.headers = headers
+
+
+"""
+Key stores
+Where verify_decode_jwt gets the key matching the kid of a token from.
+    every key store has get_key(kid), returning the key ready to be passed
+    to jwt.decode or None for an unknown kid, and refresh(force=False),
+    which (re)loads the keys and raises a 503 AuthError when none can be
+    loaded; key_store is chosen from the environment by key_store_from_env
+"""
+
+
+def jwks_unavailable():
+    return AuthError(
+        {
+            "code": "jwks_unavailable",
+            "description": "Unable to fetch the signing keys.",
+        },
+        503,
+    )
+
+
+"""
+build_keys(jwks)
+    maps the kid of each RSA signing key of a JWKS document to a key object,
+    built once; other and malformed keys are skipped
+"""
+
+
+def build_keys(jwks):
+    keys = {}
+    for key in jwks.get("keys", []):
+        if "kid" not in key or key.get("kty") != "RSA":
+            continue
+        if key.get("use", "sig") != "sig":
+            continue
+        try:
+            keys[key["kid"]] = jwk.construct(key, key.get("alg", "RS256"))
+        except JWKError:
+            continue
+    return keys
+
+
+"""
+JWKSKeyStore
+Process-wide cache of the Auth0 signing keys.
+    the JWKS document is fetched once and kept for its Cache-Control max-age
+    (capped by JWKS_MAX_TTL, JWKS_CACHE_TTL when the header is absent)
+    keys are refreshed in a background thread shortly before they expire
+    an unknown kid forces a refresh, at most once per
+    JWKS_MIN_REFRESH_INTERVAL seconds
+    if Auth0 can't be reached the last known keys keep being served
+    each kid maps to a key object built once, ready to be passed to jwt.decode
+"""
+
+
+class JWKSKeyStore:
+    def __init__(
+        self,
+        url,
+        ttl=JWKS_CACHE_TTL,
+        max_ttl=JWKS_MAX_TTL,
+        refresh_ahead=JWKS_REFRESH_AHEAD,
+        min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+        timeout=JWKS_FETCH_TIMEOUT,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        # A JWKS without usable keys is loaded too, not fetched again
+        # on every request
+        self._loaded = False
+        self._expires_at = 0
+        self._refresh_at = 0
+        self._last_refresh = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        if not self._loaded or now >= self._expires_at:
+            self.refresh()
+        elif now >= self._refresh_at:
+            self._refresh_in_background()
+        key = self._keys.get(kid)
+        if key is None and self._may_force_refresh():
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if force:
+                if not self._may_force_refresh():
+                    return
+            elif self._loaded and now < self._expires_at:
+                # Another thread refreshed while we were waiting
+                return
+            self._load(now)
+
+    def _load(self, now):
+        self._last_refresh = now
+        try:
+            jwks, ttl = self._fetch()
+        except Exception:
+            if not self._loaded:
+                raise jwks_unavailable()
+            # Serve the stale keys and retry later
+            self._expires_at = now + self.min_refresh_interval
+            self._refresh_at = self._expires_at
+            return
+        self._keys = build_keys(jwks)
+        self._loaded = True
+        self._expires_at = now + ttl
+        self._refresh_at = self._expires_at - min(self.refresh_ahead,
+                                                  ttl / 2)
+
+    def _may_force_refresh(self):
+        return (
+            self._last_refresh is None
+            or time.monotonic() - self._last_refresh
+            >= self.min_refresh_interval
+        )
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh)
+        thread.daemon = True
+        thread.start()
+
+    # Not subject to the rate limit of forced refreshes (which would delay
+    # it past the expiry of short lived keys), _refresh_at moves forward
+    # after every attempt
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._refresh_at:
+                    self._load(now)
+        except AuthError:
+            pass
+        finally:
+            self._refreshing = False
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            cache_control = response.headers.get("Cache-Control", "")
+        return jwks, self._ttl_from_cache_control(cache_control)
+
+    def _ttl_from_cache_control(self, cache_control):
+        directives = [d.strip().lower() for d in cache_control.split(",")]
+        if "no-cache" in directives or "no-store" in directives:
+            return self.min_refresh_interval
+        for directive in directives:
+            if directive.startswith("max-age="):
+                try:
+                    max_age = int(directive[len("max-age="):])
+                except ValueError:
+                    break
+                return max(self.min_refresh_interval,
+                           min(max_age, self.max_ttl))
+        return self.ttl
+
+
+"""
+JWKSFileKeyStore
+Signing keys read from a JWKS document on disk, no network involved.
+    the file is checked at most once every check_interval seconds and
+    reloaded when its modification time or size changed, so keys can be
+    rotated without restarting the workers
+    while the file is missing or invalid (e.g. half written) the last
+    loaded keys keep being served
+"""
+
+
+class JWKSFileKeyStore:
+    def __init__(self, path, check_interval=JWKS_FILE_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._keys = {}
+        self._stamp = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        if (
+            self._checked_at is None
+            or time.monotonic() - self._checked_at >= self.check_interval
+        ):
+            self.refresh()
+        return self._keys.get(kid)
+
+    def refresh(self, force=False):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if stamp == self._stamp and not force:
+                    return
+                with open(self.path) as jwks_file:
+                    keys = build_keys(json.load(jwks_file))
+            except (OSError, ValueError):
+                if self._stamp is None:
+                    raise jwks_unavailable()
+                return
+            self._keys = keys
+            self._stamp = stamp
+
+
+"""
+PEMKeyStore
+A single public key given in PEM format.
+    it verifies the tokens of any kid, or only those of kid when given
+"""
+
+
+class PEMKeyStore:
+    def __init__(self, pem, kid=None, algorithm="RS256"):
+        self.kid = kid
+        self._key = jwk.construct(pem, algorithm)
+
+    def get_key(self, kid):
+        if self.kid is not None and kid != self.kid:
+            return None
+        return self._key
+
+    def refresh(self, force=False):
+        pass
+
+
+"""
+key_store_from_env()
+    AUTH_PUBLIC_KEY (a PEM, newlines may be written as \\n) selects a
+    PEMKeyStore, else JWKS_FILE a JWKSFileKeyStore, else the Auth0 JWKS
+    (JWKS_URL) is used
+"""
+
+
+def key_store_from_env():
+    if AUTH_PUBLIC_KEY:
+        return PEMKeyStore(
+            AUTH_PUBLIC_KEY.replace("\\n", "\n"), AUTH_PUBLIC_KEY_KID
+        )
+    if JWKS_FILE:
+        return JWKSFileKeyStore(JWKS_FILE)
+    return JWKSKeyStore(JWKS_URL)
+
+
+key_store = key_store_from_env()
+
+
+"""
+TokenCache
+Bounded LRU cache of values attached to a token.
+    entries are keyed by the SHA-256 digest of the token, never the token
+    an entry is evicted at expires_at (i.e. the token exp claim) or after
+    max_age seconds, whichever comes first
+    hits and misses are counted, see stats()
+    token_cache holds verified payloads, rejected_tokens holds the
+    AuthError raised for tokens that failed verification
+"""
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, max_age=TOKEN_CACHE_MAX_AGE):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def put(self, token, value, expires_at=None):
+        if self.maxsize <= 0:
+            return
+        max_expires_at = time.time() + self.max_age
+        if expires_at is None or expires_at > max_expires_at:
+            expires_at = max_expires_at
+        digest = token_digest(token)
+        with self._lock:
+            self._entries[digest] = (value, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+token_cache = TokenCache()
+rejected_tokens = TokenCache(REJECTED_TOKEN_CACHE_SIZE, REJECTED_TOKEN_TTL)
+
+
+"""
+AuthFailureTracker
+Counts authentication failures per client in fixed windows.
+    once a client reaches `limit` failures within `window` seconds
+    check() rejects it with a 429 until the window is over
+    only tokens failing verification count, and only tokens that still
+    need to be verified are rejected (see decode_token), so a client
+    holding a valid token is never locked out by someone sharing its
+    address; off unless PROXY_FIX_X_FOR is set
+"""
+
+
+class AuthFailureTracker:
+    def __init__(self, limit=AUTH_FAILURE_LIMIT, window=AUTH_FAILURE_WINDOW,
+                 maxsize=10000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def check(self, client):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            counter = self._counters.get(client)
+            if counter is None:
+                return
+            window_start, failures = counter
+            if time.monotonic() - window_start >= self.window:
+                del self._counters[client]
+                return
+        if failures >= self.limit:
+            raise AuthError(
+                {
+                    "code": "too_many_failures",
+                    "description": "Too many failed authentication attempts.",
+                },
+                429,
+            )
+
+    def record(self, client):
+        if self.limit <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            window_start, failures = self._counters.get(client, (now, 0))
+            if now - window_start >= self.window:
+                window_start, failures = now, 0
+            self._counters[client] = (window_start, failures + 1)
+            if len(self._counters) > self.maxsize:
+                self._prune(now)
+
+    def failures(self, client):
+        with self._lock:
+            counter = self._counters.get(client)
+        if counter is None or time.monotonic() - counter[0] >= self.window:
+            return 0
+        return counter[1]
+
+    def _prune(self, now):
+        expired = [
+            client
+            for client, (window_start, _) in self._counters.items()
+            if now - window_start >= self.window
+        ]
+        for client in expired:
+            del self._counters[client]
+
+
+auth_failures = AuthFailureTracker()
+
+
+"""
+Rate limiting
+Token buckets per subject (the sub claim) and per subject and permission.
+    a bucket holds up to `burst` requests and refills at `rate` requests
+    per second; a request without a token left gets a 429 with Retry-After
+    RATE_LIMIT_PER_SUBJECT ("rate:burst") applies to every request of a
+    subject, RATE_LIMIT_PER_PERMISSION ("permission=rate:burst,...") to the
+    requests needing the given permissions; both are off by default
+    buckets live in process (MemoryBucketStore) or, when RATE_LIMIT_DB is
+    set, in a SQLite database shared by the gunicorn workers of the host
+    (SQLiteBucketStore), through one connection per process; the SQLite
+    store lets requests through when the database can't be used or stays
+    locked for more than BUSY_TIMEOUT
+    a request takes from all of its buckets or, when one of them is empty,
+    from none of them
+"""
+
+
+def parse_limit(limit):
+    rate, _, burst = limit.partition(":")
+    return float(rate), float(burst or rate)
+
+
+def parse_permission_limits(limits):
+    parsed = {}
+    for item in filter(None, (part.strip() for part in limits.split(","))):
+        permission, _, limit = item.partition("=")
+        parsed[permission] = parse_limit(limit)
+    return parsed
+
+
+# Tokens left after taking one from the bucket, negative if it was empty
+def refill(tokens, updated, now, rate, burst):
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    return tokens - 1
+
+
+class MemoryBucketStore:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        return self.take_all([(key, rate, burst)])
+
+    # One token from each (key, rate, burst) bucket, or the longest wait
+    # for an empty one and nothing taken
+    def take_all(self, limits):
+        now = time.time()
+        with self._lock:
+            taken = []
+            for key, rate, burst in limits:
+                tokens, updated = self._buckets.get(key, (burst, now))
+                taken.append((key, rate, refill(tokens, updated, now, rate,
+                                                burst)))
+            retry_after = max(
+                (-tokens / rate for key, rate, tokens in taken if tokens < 0),
+                default=0,
+            )
+            if retry_after:
+                return retry_after
+            for key, rate, tokens in taken:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return 0
+
+
+class SQLiteBucketStore:
+    CREATE = (
+        "CREATE TABLE IF NOT EXISTS buckets "
+        "(key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+    )
+    # Buckets untouched for this long are full again and can be dropped
+    EXPIRY = 3600
+    # Transactions take microseconds, a longer wait means the database is
+    # stuck: let the request through rather than hold the worker (all of
+    # its greenlets with the gevent worker class)
+    BUSY_TIMEOUT = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        return self.take_all([(key, rate, burst)])
+
+    def take_all(self, limits):
+        now = time.time()
+        try:
+            with self._lock:
+                return self._take_all(limits, now)
+        except sqlite3.Error:
+            return 0
+
+    def _take_all(self, limits, now):
+        connection = self._connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            taken = []
+            for key, rate, burst in limits:
+                row = connection.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row or (burst, now)
+                taken.append((key, rate, refill(tokens, updated, now, rate,
+                                                burst)))
+            retry_after = max(
+                (-tokens / rate for key, rate, tokens in taken if tokens < 0),
+                default=0,
+            )
+            if retry_after:
+                return retry_after
+            connection.executemany(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                [(key, tokens, now) for key, rate, tokens in taken],
+            )
+            if random.random() < 0.001:
+                connection.execute(
+                    "DELETE FROM buckets WHERE updated < ?",
+                    (now - self.EXPIRY,),
+                )
+        return 0
+
+    def _connect(self):
+        # One connection per process (threads and greenlets take turns
+        # under _lock), never inherited from a parent process
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(self.CREATE)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        store,
+        subject_limit=None,
+        permission_limits=None,
+    ):
+        self.store = store
+        self.subject_limit = subject_limit
+        self.permission_limits = permission_limits or {}
+
+    def check(self, subject, permission):
+        limits = []
+        if permission in self.permission_limits:
+            rate, burst = self.permission_limits[permission]
+            limits.append((f"{subject}|{permission}", rate, burst))
+        if self.subject_limit:
+            limits.append((subject, *self.subject_limit))
+        if limits:
+            retry_after = self.store.take_all(limits)
+            if retry_after:
+                raise AuthError(
+                    {
+                        "code": "rate_limited",
+                        "description": "Too many requests.",
+                    },
+                    429,
+                    {"Retry-After": str(math.ceil(retry_after))},
+                )
+
+
+rate_limiter = RateLimiter(
+    SQLiteBucketStore(RATE_LIMIT_DB) if RATE_LIMIT_DB
+    else MemoryBucketStore(),
+    parse_limit(RATE_LIMIT_PER_SUBJECT) if RATE_LIMIT_PER_SUBJECT else None,
+    parse_permission_limits(RATE_LIMIT_PER_PERMISSION),
+)
+
+
+"""
+Load shedding
+Rejects requests with a 503 before any token or database work when the
+worker is saturated.
+    at most MAX_CONCURRENT_REQUESTS authenticated requests run at once in
+    a worker (i.e. with the gevent worker class)
+    with MAX_QUEUE_TIME (milliseconds) a request that waited longer than
+    that in front of the app, according to the X-Request-Start header of
+    the router (Heroku), is dropped, its client has likely given up
+    both are off by default
+"""
+
+
+# Seconds since the X-Request-Start timestamp ("t=" prefixed or not, in
+# seconds, milliseconds or microseconds), None when it's not a timestamp
+def queue_time(header, now):
+    try:
+        started = float(header.strip().lstrip("t="))
+    except ValueError:
+        return None
+    while started > now * 100:
+        started /= 1000
+    return now - started
+
+
+class LoadShedder:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                 max_queue_time=MAX_QUEUE_TIME):
+        self.max_concurrent = max_concurrent
+        self.max_queue_time = max_queue_time
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        if self.max_queue_time:
+            waited = queue_time(
+                request.headers.get("X-Request-Start", ""), time.time()
+            )
+            if waited is not None and waited * 1000 > self.max_queue_time:
+                raise self._overloaded()
+        if not self.max_concurrent:
+            yield
+            return
+        with self._lock:
+            if self.in_flight >= self.max_concurrent:
+                raise self._overloaded()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _overloaded(self):
+        return AuthError(
+            {
+                "code": "overloaded",
+                "description": "The server is overloaded, try again later.",
+            },
+            503,
+            {"Retry-After": "1"},
+        )
+
+
+load_shedder = LoadShedder()
 
 
 """
@@ -43,7 +745,7 @@ def get_token_auth_header():
             401,
         )
     parts = auth.split()
-    if parts[0].lower() != "bearer":
+    if not parts or parts[0].lower() != "bearer":
         raise AuthError(
             {
                 "code": "invalid_header",
@@ -102,26 +804,28 @@ def check_permissions(permission, payload):
 
 
 """
-@TODO implement verify_decode_jwt(token) method
-    @INPUTS
-        token: a json web token (string)
-
-    it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
-    it should decode the payload from the token
-    it should validate the claims
-    return the decoded payload
-
-    !!NOTE urlopen has a common certificate error described here:
-     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+prevalidate_token(token)
+    cheap checks done before any key lookup or signature verification
+    it should raise an AuthError if the token isn't made of three segments
+    it should raise an AuthError if the header can't be decoded, has no
+    string kid or uses an algorithm other than the allowed ones
+    it should raise an AuthError if the (unverified) exp claim is in the past
+    return the unverified header
 """
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+def prevalidate_token(token):
+    if token.count(".") != 2:
+        raise AuthError(
+            {
+                "code": "invalid_header",
+                "description": "Malformed Token",
+            },
+            401,
+        )
     try:
         unverified_header = jwt.get_unverified_header(token)
+        unverified_claims = jwt.get_unverified_claims(token)
     except Exception:
         raise AuthError(
             {
@@ -130,8 +834,8 @@ def verify_decode_jwt(token):
             },
             401,
         )
-    rsa_key = {}
-    if "kid" not in unverified_header:
+    # A list or object kid can't be looked up in the key stores
+    if not isinstance(unverified_header.get("kid"), str):
         raise AuthError(
             {
                 "code": "invalid_header",
@@ -139,21 +843,52 @@ def verify_decode_jwt(token):
             },
             401,
         )
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
+    if unverified_header.get("alg") not in ALLOWED_ALGORITHMS:
+        raise AuthError(
+            {
+                "code": "invalid_header",
+                "description": "Unsupported token algorithm.",
+            },
+            401,
+        )
+    exp = unverified_claims.get("exp")
+    if isinstance(exp, (int, float)) and exp <= time.time():
+        raise AuthError(
+            {
+                "code": "token_expired",
+                "description": "Token expired.",
+            },
+            401,
+        )
+    return unverified_header
+
+
+"""
+@TODO implement verify_decode_jwt(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    it should be an Auth0 token with key id (kid)
+    it should reject it with prevalidate_token before fetching any key
+    it should verify the token using Auth0 /.well-known/jwks.json
+    it should decode the payload from the token
+    it should validate the claims
+    return the decoded payload
+
+    !!NOTE urlopen has a common certificate error described here:
+     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+"""
+
+
+def verify_decode_jwt(token):
+    unverified_header = prevalidate_token(token)
+    rsa_key = key_store.get_key(unverified_header["kid"])
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
+                algorithms=ALLOWED_ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer="https://" + AUTH0_DOMAIN + "/",
             )
@@ -192,28 +927,83 @@ def verify_decode_jwt(token):
     )
 
 
+"""
+decode_token(token, client=None)
+    return the payload of an already verified token from token_cache
+    when client is given, it should reject the client if it has too many
+    recent failures and count the failure if the token is rejected
+    it should raise the cached AuthError of a recently rejected token
+    otherwise verify the token with verify_decode_jwt and cache the outcome
+"""
+
+
+def decode_token(token, client=None):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    if client is not None:
+        auth_failures.check(client)
+    rejected = rejected_tokens.get(token)
+    if rejected is not None:
+        if client is not None:
+            auth_failures.record(client)
+        raise AuthError(*rejected)
+    try:
+        payload = verify_decode_jwt(token)
+    except AuthError as error:
+        # Don't hold Auth0 being unreachable against the token or client
+        if error.status_code != 503:
+            rejected_tokens.put(token, (error.error, error.status_code))
+            if client is not None:
+                auth_failures.record(client)
+        raise
+    token_cache.put(token, payload, payload.get("exp"))
+    return payload
+
+
 """
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
+    it should shed the request when the worker is overloaded
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the decode_token method to decode the jwt, rejecting
+    clients with too many recent token failures
     it should use the check_permissions method validate claims
     and check the requested permission
+    it should apply the rate limits of the subject and permission
+    it should record its duration and the AuthError it raises, if any
+    (see metrics.py and profiling.py)
     return the decorator which passes the decoded payload
     to the decorated method
 """
 
 
+def authorize(permission):
+    token = get_token_auth_header()
+    payload = decode_token(token, request.remote_addr)
+    check_permissions(permission, payload)
+    rate_limiter.check(payload.get("sub"), permission)
+    return payload
+
+
 def requires_auth(permission=""):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with load_shedder.slot():
+                started = time.perf_counter()
+                try:
+                    payload = authorize(permission)
+                except AuthError as error:
+                    elapsed = time.perf_counter() - started
+                    observe_auth(permission, elapsed, error)
+                    raise
+                finally:
+                    record_timing("auth", time.perf_counter() - started)
+                observe_auth(permission, time.perf_counter() - started)
+                return f(payload, *args, **kwargs)
 
         return wrapper
 
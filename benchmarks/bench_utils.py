@@ -0,0 +1,189 @@
+"""
+Shared helpers of the benchmark suite (hot_paths.py, routes.py,
+load_test.py).
+
+offline_auth() must run before the app modules are imported: it signs
+tokens with a locally generated RSA key (see mint_token.py) and points
+JWKS_FILE to a JWKS file holding its public part, so no request goes to
+Auth0.
+
+Results are saved as JSON in benchmarks/results/ (ignored by git), named
+after the suite and the current commit, and can be compared with the
+results of another commit with --compare.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+AUDIENCE = "trivia-benchmark"
+DOMAIN = "benchmark.local"
+KID = "benchmark-key"
+
+sys.path.insert(0, ROOT)
+
+from mint_token import ROLES, generate_key, mint, public_jwks  # noqa: E402
+
+ALL_PERMISSIONS = ROLES["admin"]
+
+
+class OfflineAuth:
+    def __init__(self):
+        key = generate_key()
+        self.private_pem = key.exportKey("PEM").decode("utf-8")
+        self.jwks = public_jwks(key, KID)
+
+    def token(self, permissions=ALL_PERMISSIONS, subject="benchmark|1",
+              expires_in=3600):
+        return mint(
+            self.private_pem,
+            permissions,
+            subject=subject,
+            expires_in=expires_in,
+            kid=KID,
+            domain=DOMAIN,
+            audience=AUDIENCE,
+        )
+
+
+def offline_auth():
+    auth = OfflineAuth()
+    fd, path = tempfile.mkstemp(prefix="trivia-jwks-", suffix=".json")
+    with os.fdopen(fd, "w") as jwks_file:
+        json.dump(auth.jwks, jwks_file)
+    os.environ["AUTH0_DOMAIN"] = DOMAIN
+    os.environ["API_AUDIENCE"] = AUDIENCE
+    os.environ["ALGORITHMS"] = "RS256"
+    os.environ["JWKS_FILE"] = path
+    return auth
+
+
+"""
+seed(rows)
+    empties the database of the app in the current app context and fills it
+    with the benchmark categories and rows generated questions
+"""
+
+CATEGORIES = ["Science", "Art", "Geography", "History", "Entertainment",
+              "Sports"]
+SEED_BATCH_SIZE = 10000
+
+
+def seed(rows):
+    from caching import category_catalog
+    from models import (db, commit_changes, reconcile_question_counts,
+                        table_versions, Category, Question)
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    # The versions restart from scratch, drop what was cached for a
+    # previous seed
+    for table in ("questions", "categories"):
+        table_versions.invalidate(table)
+    category_catalog.clear()
+    for type in CATEGORIES:
+        db.session.add(Category(type))
+    db.session.commit()
+    postgresql = db.engine.dialect.name == "postgresql"
+    for start in range(0, rows, SEED_BATCH_SIZE):
+        batch = [
+            {
+                "question": f"Benchmark question number {i}?",
+                "answer": f"Answer {i}",
+                "category": 1 + i % len(CATEGORIES),
+                "difficulty": 1 + i % 5,
+            }
+            for i in range(start, min(rows, start + SEED_BATCH_SIZE))
+        ]
+        if postgresql:
+            Question.bulk_insert(batch)
+        else:
+            db.session.execute(Question.__table__.insert(), batch)
+            db.session.commit()
+    # Core inserts don't maintain the question counters
+    reconcile_question_counts()
+    commit_changes("questions", "categories")
+    if postgresql:
+        db.session.execute("ANALYZE questions")
+        db.session.commit()
+    db.session.remove()
+
+
+"""
+measure(function, number, repeat)
+    runs the function number times, repeat times over, and returns the
+    best time per call in seconds
+"""
+
+
+def measure(function, number, repeat=5):
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    return best / number
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+        dirty = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty else "")
+
+
+def save_results(suite, results, **metadata):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    revision = git_revision()
+    path = os.path.join(RESULTS_DIR, f"{suite}-{revision}.json")
+    document = {
+        "suite": suite,
+        "revision": revision,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        **metadata,
+        "results": results,
+    }
+    with open(path, "w") as results_file:
+        json.dump(document, results_file, indent=2, sort_keys=True)
+    print(f"\nResults saved to {os.path.relpath(path)}")
+    return path
+
+
+"""
+compare(results, baseline_path)
+    prints the change of every result against the results saved in
+    baseline_path, slower being positive
+"""
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nCompared to {baseline['revision']} ({baseline['date']}):")
+    for name, seconds in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            print(f"  {name:<48} new")
+            continue
+        change = (seconds - before) / before * 100
+        print(
+            f"  {name:<48} {before * 1e6:12.1f} us -> "
+            f"{seconds * 1e6:12.1f} us  {change:+6.1f}%"
+        )
+
+
+def report(name, seconds):
+    print(f"  {name:<48} {seconds * 1e6:12.1f} us")
@@ -0,0 +1,121 @@
+"""
+Microbenchmarks of the auth and serialization hot paths.
+
+Times, per call: get_token_auth_header, prevalidate_token,
+verify_decode_jwt (RS256 signature check), decode_token (token cache hit),
+check_permissions, the whole requires_auth wrapper, Question.format,
+format_rows, paginate_response and paginate_after (against an in-memory
+SQLite database of --rows questions) and the JSON encoding of a page.
+
+Tokens are signed with a locally generated RSA key, the JWKS is read from a
+temporary file, nothing goes over the network.
+
+    python benchmarks/hot_paths.py
+    python benchmarks/hot_paths.py --compare \
+        benchmarks/results/hot_paths-1a2b3c4.json
+"""
+import argparse
+import os
+
+from bench_utils import (compare, measure, offline_auth, report,
+                         save_results, seed)
+
+tokens = offline_auth()
+os.environ["DATABASE_URL"] = "sqlite://"
+
+from auth import (check_permissions, decode_token,  # noqa: E402
+                  get_token_auth_header, prevalidate_token, requires_auth,
+                  verify_decode_jwt)
+from app import app, paginate_after, paginate_response  # noqa: E402
+from models import db, format_rows, Question  # noqa: E402
+from serialization import dumps  # noqa: E402
+
+
+def auth_benchmarks(token, payload):
+    headers = {"Authorization": "Bearer " + token}
+    protected = requires_auth("get:questions")(lambda payload: payload)
+    with app.test_request_context(headers=headers):
+        yield "get_token_auth_header", get_token_auth_header, 100000
+        yield "prevalidate_token", lambda: prevalidate_token(token), 20000
+        yield "verify_decode_jwt", lambda: verify_decode_jwt(token), 500
+        yield "decode_token (cached)", lambda: decode_token(token), 100000
+        yield (
+            "check_permissions",
+            lambda: check_permissions("get:questions", payload),
+            100000,
+        )
+        yield "requires_auth (cached token)", protected, 20000
+
+
+def serialization_benchmarks(rows):
+    questions = [
+        Question(f"Question {i}?", f"Answer {i}", 1 + i % 4, 1 + i % 5)
+        for i in range(1000)
+    ]
+    for id, question in enumerate(questions, 1):
+        question.id = id
+    tuples = [
+        (q.id, q.question, q.answer, q.category, q.difficulty)
+        for q in questions
+    ]
+    page = {"questions": format_rows(tuples[:10]), "total_questions": rows}
+    yield (
+        "Question.format x1000",
+        lambda: [question.format() for question in questions],
+        100,
+    )
+    yield "format_rows x1000", lambda: format_rows(tuples), 100
+    yield "dumps (page of 10)", lambda: dumps(page), 20000
+
+
+def pagination_benchmarks(rows):
+    def paginate(page=1, after_id=None):
+        def run():
+            if after_id is None:
+                paginate_response(page, Question.select_rows())
+            else:
+                paginate_after(Question.select_rows(), after_id)
+            db.session.remove()
+
+        return run
+
+    last_page = rows // 10
+    yield "paginate_response page=1", paginate(), 1000
+    yield f"paginate_response page={last_page}", paginate(last_page), 200
+    yield (
+        f"paginate_after after_id={rows - 10}",
+        paginate(after_id=rows - 10),
+        1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--compare", metavar="RESULTS_FILE")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    token = tokens.token()
+    payload = verify_decode_jwt(token)
+    results = {}
+    with app.app_context():
+        seed(args.rows)
+        benchmarks = [
+            auth_benchmarks(token, payload),
+            serialization_benchmarks(args.rows),
+            pagination_benchmarks(args.rows),
+        ]
+        for group in benchmarks:
+            for name, function, number in group:
+                results[name] = measure(function, number, args.repeat)
+                report(name, results[name])
+    if not args.no_save:
+        save_results("hot_paths", results, rows=args.rows)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
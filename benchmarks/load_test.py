@@ -0,0 +1,426 @@
+"""
+Load test of app:app with a mix of player, QA and admin traffic.
+
+Boots gunicorn (configured by gunicorn.conf.py) against a seeded database
+and offline signing keys, sends --rate requests per second from
+--concurrency client threads for --duration seconds, then reports per
+route the throughput, error rate and p50/p95/p99 latency.
+
+    python benchmarks/load_test.py --rate 200 --concurrency 100
+    python benchmarks/load_test.py --mix player=80,qa=15,admin=5 \\
+        --workers 4 --worker-class gevent
+
+Each request is picked from the traffic of a role, chosen according to
+--mix:
+- player: list the categories, play quiz turns
+- qa: list questions (random pages), list a category, search
+- admin: create, patch and delete questions
+
+Latencies are measured from the time a request was scheduled, so the
+queueing delay of a server that can't keep up with the rate is counted
+instead of hidden.
+
+The database is LOADTEST_DATABASE_URL, a temporary SQLite database by
+default, and every table of that database is dropped. With --url the load
+goes to an already running server instead: nothing is seeded and tokens
+are signed with --key, see mint_token.py.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from bench_utils import (CATEGORIES, ROOT, compare, offline_auth,
+                         save_results, seed)
+from mint_token import ROLES, mint
+
+READY_TIMEOUT = 60
+
+
+class Request:
+    def __init__(self, label, method, path, body=None, handle=None):
+        self.label = label
+        self.method = method
+        self.path = path
+        self.body = body
+        self.handle = handle
+
+
+"""
+VirtualUser
+State of a client thread: its keep-alive connection, one token per role,
+the questions of its current quiz and the questions it created.
+"""
+
+
+class VirtualUser:
+    def __init__(self, address, tokens, rows, rng):
+        self.address = address
+        self.tokens = tokens
+        self.rows = rows
+        self.rng = rng
+        self.connection = http.client.HTTPConnection(*address, timeout=30)
+        self.quiz_category = None
+        self.previous_questions = []
+        self.created = []
+
+    def next_request(self, role):
+        return getattr(self, role)()
+
+    def player(self):
+        if self.rng.random() < 0.1:
+            return Request("GET /categories", "GET", "/categories")
+        if self.quiz_category is None or len(self.previous_questions) >= 10:
+            self.quiz_category = self.rng.randint(1, len(CATEGORIES))
+            self.previous_questions = []
+
+        def handle(status, data):
+            question = data.get("question") if status == 200 else None
+            if question:
+                self.previous_questions.append(question["id"])
+            else:
+                self.quiz_category = None
+
+        return Request(
+            "POST /quizzes",
+            "POST",
+            "/quizzes",
+            {
+                "previous_questions": self.previous_questions,
+                "quiz_category": {"id": self.quiz_category},
+            },
+            handle,
+        )
+
+    def qa(self):
+        choice = self.rng.random()
+        if choice < 0.5:
+            page = self.rng.randint(1, max(1, self.rows // 10))
+            return Request("GET /questions", "GET", f"/questions?page={page}")
+        if choice < 0.75:
+            category = self.rng.randint(1, len(CATEGORIES))
+            return Request(
+                "GET /categories/<id>/questions",
+                "GET",
+                f"/categories/{category}/questions",
+            )
+        term = f"number {self.rng.randint(0, max(0, self.rows - 1))}"
+        return Request(
+            "POST /questions/search",
+            "POST",
+            "/questions/search",
+            {"searchTerm": term},
+        )
+
+    def admin(self):
+        choice = self.rng.random()
+        if self.created and choice < 0.33:
+            question_id = self.created[-1]
+            return Request(
+                "PATCH /questions/<id>",
+                "PATCH",
+                f"/questions/{question_id}",
+                {"difficulty": self.rng.randint(1, 5)},
+            )
+        if self.created and choice < 0.66:
+            question_id = self.created.pop()
+            return Request(
+                "DELETE /questions/<id>", "DELETE", f"/questions/{question_id}"
+            )
+
+        def handle(status, data):
+            if status == 200:
+                self.created.append(data["question_id"])
+
+        return Request(
+            "POST /questions",
+            "POST",
+            "/questions",
+            {
+                "question": "Load test question?",
+                "answer": "Load test answer",
+                "category": self.rng.randint(1, len(CATEGORIES)),
+                "difficulty": self.rng.randint(1, 5),
+            },
+            handle,
+        )
+
+    def send(self, role, request):
+        headers = {"Authorization": "Bearer " + self.tokens[role]}
+        body = None
+        if request.body is not None:
+            body = json.dumps(request.body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(request.method, request.path, body,
+                                    headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnects on the next request
+            self.connection.close()
+            return None
+        if request.handle is not None:
+            try:
+                request.handle(response.status, json.loads(data))
+            except ValueError:
+                pass
+        return response.status
+
+
+def client(index, address, tokens, rows, roles, weights, jobs, samples):
+    rng = random.Random(index)
+    user = VirtualUser(address, tokens, rows, rng)
+    while True:
+        due = jobs.get()
+        if due is None:
+            return
+        role = rng.choices(roles, weights)[0]
+        request = user.next_request(role)
+        status = user.send(role, request)
+        samples.append((request.label, time.perf_counter() - due, status))
+
+
+"""
+run_load(...)
+    schedules rate requests per second for duration seconds, executed by
+    concurrency client threads, and returns the (route, latency, status)
+    samples and the time it took
+"""
+
+
+def run_load(address, tokens, rows, mix, rate, concurrency, duration):
+    roles = list(mix)
+    weights = [mix[role] for role in roles]
+    jobs = queue.Queue()
+    samples = []
+    threads = [
+        threading.Thread(
+            target=client,
+            args=(index, address, tokens[index], rows, roles, weights, jobs,
+                  samples),
+            daemon=True,
+        )
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    for number in range(int(rate * duration)):
+        due = started + number / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        jobs.put(due)
+    for thread in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def percentile(latencies, percent):
+    index = max(0, math.ceil(percent / 100 * len(latencies)) - 1)
+    return latencies[index]
+
+
+def summarize(samples, elapsed):
+    routes = defaultdict(list)
+    for label, latency, status in samples:
+        routes[label].append((latency, status))
+        routes["all"].append((latency, status))
+    summary = {}
+    for label, route_samples in routes.items():
+        latencies = sorted(latency for latency, _ in route_samples)
+        errors = sum(
+            1 for _, status in route_samples
+            if status is None or status >= 400
+        )
+        summary[label] = {
+            "requests": len(route_samples),
+            "throughput": len(route_samples) / elapsed,
+            "error_rate": errors / len(route_samples),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+    return summary
+
+
+def report(summary):
+    print(
+        f"\n{'route':<32} {'requests':>8} {'req/s':>8} {'errors':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for label in sorted(summary, key=lambda label: (label == "all", label)):
+        route = summary[label]
+        print(
+            f"{label:<32} {route['requests']:>8} "
+            f"{route['throughput']:>8.1f} {route['error_rate']:>7.1%} "
+            f"{route['p50'] * 1000:>8.1f} {route['p95'] * 1000:>8.1f} "
+            f"{route['p99'] * 1000:>8.1f}"
+        )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(address, server):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(
+                f"gunicorn exited with code {server.returncode}"
+            )
+        connection = http.client.HTTPConnection(*address, timeout=1)
+        try:
+            connection.request("GET", "/")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+        finally:
+            connection.close()
+    raise RuntimeError("gunicorn didn't start in time")
+
+
+def boot(args):
+    os.environ["DATABASE_URL"] = os.getenv(
+        "LOADTEST_DATABASE_URL",
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.db"),
+    )
+    os.environ["DB_CREATE_ALL"] = "false"
+    from app import app
+    from models import dispose_engines
+
+    with app.app_context():
+        print(f"Seeding {args.rows} questions")
+        seed(args.rows)
+    dispose_engines(app)
+
+    address = ("127.0.0.1", free_port())
+    log = tempfile.NamedTemporaryFile(prefix="trivia-gunicorn-",
+                                      suffix=".log", delete=False)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app",
+         "--bind", f"{address[0]}:{address[1]}",
+         "--workers", str(args.workers)],
+        cwd=ROOT,
+        env=dict(os.environ, GUNICORN_WORKER_CLASS=args.worker_class),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    print(f"Starting gunicorn on port {address[1]}, log in {log.name}")
+    try:
+        wait_until_ready(address, server)
+    except RuntimeError:
+        server.terminate()
+        raise
+    return address, server
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        role, _, weight = part.partition("=")
+        if role not in ROLES:
+            raise argparse.ArgumentTypeError(f"unknown role {role}")
+        weights[role] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rate", type=float, default=100,
+                        help="requests per second")
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="client threads")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds")
+    parser.add_argument("--mix", type=parse_mix,
+                        default="player=70,qa=20,admin=10")
+    parser.add_argument("--rows", type=int, default=10000,
+                        help="questions to seed")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--worker-class", default="sync")
+    parser.add_argument("--url", help="load an already running server")
+    parser.add_argument("--key", help="private key (PEM) for --url")
+    parser.add_argument("--compare", metavar="RESULTS_FILE")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        if not args.key:
+            parser.error("--url requires --key")
+        url = urlsplit(args.url)
+        address = (url.hostname, url.port or 80)
+        with open(args.key) as private_file:
+            private_pem = private_file.read()
+
+        def sign(permissions, subject):
+            return mint(private_pem, permissions, subject=subject)
+    else:
+        auth = offline_auth()
+
+        def sign(permissions, subject):
+            return auth.token(permissions, subject=subject)
+
+        address, server = boot(args)
+    tokens = [
+        {role: sign(ROLES[role], f"loadtest|{role}-{index}")
+         for role in args.mix}
+        for index in range(args.concurrency)
+    ]
+    print(
+        f"{args.rate:g} requests/s for {args.duration:g}s from "
+        f"{args.concurrency} clients, mix {args.mix}"
+    )
+    try:
+        samples, elapsed = run_load(address, tokens, args.rows, args.mix,
+                                    args.rate, args.concurrency,
+                                    args.duration)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    summary = summarize(samples, elapsed)
+    report(summary)
+
+    results = {
+        f"{label} {stat}": route[stat]
+        for label, route in summary.items()
+        for stat in ("p50", "p95", "p99")
+    }
+    if not args.no_save:
+        save_results(
+            "load_test",
+            results,
+            summary=summary,
+            rate=args.rate,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            mix=args.mix,
+            workers=args.workers,
+            worker_class=args.worker_class,
+        )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
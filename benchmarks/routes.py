@@ -0,0 +1,150 @@
+"""
+Route benchmarks against seeded tables of 10k, 100k and 1M questions.
+
+For each table size the database is emptied and seeded, then every route
+is called through the Flask test client with an admin token (signed with a
+locally generated RSA key, see bench_utils.py) and timed per request.
+
+    python benchmarks/routes.py
+    python benchmarks/routes.py --rows 10000 --rows 100000
+    python benchmarks/routes.py --compare \
+        benchmarks/results/routes-1a2b3c4.json
+
+Runs against BENCHMARK_DATABASE_URL, a temporary SQLite database by
+default. Every table of that database is dropped, never point it to a
+database holding real data.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from bench_utils import (ALL_PERMISSIONS, compare, measure, offline_auth,
+                         report, save_results, seed)
+
+tokens = offline_auth()
+os.environ["DATABASE_URL"] = os.getenv(
+    "BENCHMARK_DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db"),
+)
+os.environ["DB_CREATE_ALL"] = "false"
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+TIME_BUDGET = 0.5
+
+
+def requests(rows, client, headers):
+    last_page = rows // 10
+    previous = list(range(1, rows, max(1, rows // 10)))[:10]
+
+    def call(method, url, status=200, **kwargs):
+        def run():
+            response = client.open(url, method=method, headers=headers,
+                                   **kwargs)
+            response.get_data()
+            if response.status_code != status:
+                raise RuntimeError(
+                    f"{method} {url}: {response.status_code} {response.data}"
+                )
+            return response
+
+        return run
+
+    def create_delete():
+        created = call(
+            "POST",
+            "/questions",
+            json={"question": "q?", "answer": "a", "category": 1,
+                  "difficulty": 1},
+        )()
+        call("DELETE", f"/questions/{created.json['question_id']}")()
+
+    yield "GET /categories", call("GET", "/categories")
+    yield "GET /questions?page=1", call("GET", "/questions?page=1")
+    yield (
+        "GET /questions?page=<last>",
+        call("GET", f"/questions?page={last_page}"),
+    )
+    yield (
+        "GET /questions?after_id=<last page>",
+        call("GET", f"/questions?after_id={rows - 10}"),
+    )
+    yield (
+        "GET /categories/1/questions",
+        call("GET", "/categories/1/questions?page=1"),
+    )
+    for mode in ("substring", "fulltext"):
+        yield (
+            f"POST /questions/search ({mode})",
+            call(
+                "POST",
+                "/questions/search",
+                json={"searchTerm": "number 4242", "mode": mode},
+            ),
+        )
+    yield (
+        "POST /quizzes",
+        call(
+            "POST",
+            "/quizzes",
+            json={"previous_questions": previous,
+                  "quiz_category": {"id": 1}},
+        ),
+    )
+    yield (
+        "PATCH /questions/1",
+        call("PATCH", "/questions/1", json={"difficulty": 2}),
+    )
+    yield "POST + DELETE /questions", create_delete
+    yield (
+        "GET /questions/export?category=1",
+        call("GET", "/questions/export?category=1"),
+    )
+
+
+"""
+calibrate(function)
+    number of calls taking about TIME_BUDGET seconds, at least one
+"""
+
+
+def calibrate(function):
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    return max(1, int(TIME_BUDGET / max(elapsed, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, action="append")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compare", metavar="RESULTS_FILE")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+    sizes = args.rows or [10000, 100000, 1000000]
+
+    headers = {"Authorization": "Bearer " + tokens.token(ALL_PERMISSIONS)}
+    client = app.test_client()
+    results = {}
+    with app.app_context():
+        dialect = db.engine.dialect.name
+    for rows in sizes:
+        with app.app_context():
+            print(f"Seeding {rows} questions ({dialect})")
+            seed(rows)
+        for name, function in requests(rows, client, headers):
+            number = calibrate(function)
+            key = f"{rows} {name}"
+            results[key] = measure(function, number, args.repeat)
+            report(key, results[key])
+    if not args.no_save:
+        save_results("routes", results, database=dialect, sizes=sizes)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
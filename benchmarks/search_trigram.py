@@ -0,0 +1,91 @@
+"""
+Substring search benchmark, with and without the pg_trgm index.
+
+Seeds a scratch copy of the questions table with generated rows, times
+the ILIKE '%term%' query used by POST /questions/search, adds the trigram
+index and times it again. The questions table itself is not touched.
+
+    python benchmarks/search_trigram.py --rows 1000000 --term "4f2a"
+
+Requires DATABASE_URL to point to a PostgreSQL database where pg_trgm
+can be installed.
+"""
+import argparse
+import os
+import time
+from sqlalchemy import create_engine, text
+
+TABLE = "bench_questions_trgm"
+
+
+def seed(connection, rows):
+    connection.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    connection.execute(
+        f"CREATE TABLE {TABLE} (id serial PRIMARY KEY, question varchar)"
+    )
+    connection.execute(
+        text(
+            f"INSERT INTO {TABLE} (question) "
+            "SELECT 'Which question has the code ' || md5(i::text) || '?' "
+            "FROM generate_series(1, :rows) AS i"
+        ),
+        rows=rows,
+    )
+    connection.execute(f"ANALYZE {TABLE}")
+
+
+def time_query(connection, term, repeat):
+    query = text(
+        f"SELECT id, question FROM {TABLE} "
+        "WHERE question ILIKE :pattern ORDER BY id LIMIT 10"
+    )
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(query, pattern=f"%{term}%").fetchall()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def explain(connection, term):
+    plan = connection.execute(
+        text(
+            f"EXPLAIN SELECT id FROM {TABLE} "
+            "WHERE question ILIKE :pattern ORDER BY id LIMIT 10"
+        ),
+        pattern=f"%{term}%",
+    ).fetchall()
+    return "\n".join(row[0] for row in plan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--term", default="4f2a")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    with engine.connect() as connection:
+        print(f"Seeding {args.rows} rows...")
+        seed(connection, args.rows)
+        try:
+            without_index = time_query(connection, args.term, args.repeat)
+            print(explain(connection, args.term))
+            connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            connection.execute(
+                f"CREATE INDEX ON {TABLE} USING GIN (question gin_trgm_ops)"
+            )
+            connection.execute(f"ANALYZE {TABLE}")
+            with_index = time_query(connection, args.term, args.repeat)
+            print(explain(connection, args.term))
+        finally:
+            connection.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    print(f"median without trigram index: {without_index * 1000:.2f} ms")
+    print(f"median with trigram index:    {with_index * 1000:.2f} ms")
+    print(f"speedup: {without_index / with_index:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
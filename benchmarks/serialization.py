@@ -0,0 +1,86 @@
+"""
+Listing serialization benchmark: ORM objects + format() + jsonify-style
+encoding, against column rows + format_rows() + serialization.dumps().
+
+Runs against an in-memory SQLite database seeded with generated questions,
+so it measures the Python side (object building and JSON encoding) only.
+
+    python benchmarks/serialization.py --rows 100000 --limit 1000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import (db, setup_db, format_rows,  # noqa: E402
+                    Category, Question)
+from serialization import dumps, orjson  # noqa: E402
+
+
+def seed(rows):
+    for type in ["Science", "Art", "Geography", "History"]:
+        db.session.add(Category(type))
+    db.session.commit()
+    Question.bulk_insert(
+        [
+            {
+                "question": f"Benchmark question number {i}?",
+                "answer": f"Answer {i}",
+                "category": 1 + i % 4,
+                "difficulty": 1 + i % 5,
+            }
+            for i in range(rows)
+        ]
+    )
+
+
+def orm_format(limit):
+    questions = Question.query.order_by(Question.id).limit(limit).all()
+    payload = {"questions": [question.format() for question in questions]}
+    db.session.remove()
+    return json.dumps(payload)
+
+
+def column_rows(limit):
+    rows = Question.select_rows().order_by(Question.id).limit(limit)
+    payload = {"questions": format_rows(rows)}
+    db.session.remove()
+    return dumps(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--limit", type=int, action="append")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    limits = args.limit or [10, 1000, args.rows]
+
+    app = Flask(__name__)
+    setup_db(app, "sqlite://")
+    with app.app_context():
+        seed(args.rows)
+        print(f"JSON encoder: {'orjson' if orjson else 'json'}")
+        for limit in limits:
+            number = max(1, 10000 // limit)
+            results = {}
+            for name, path in [("orm + format()", orm_format),
+                               ("column rows", column_rows)]:
+                best = min(
+                    timeit.repeat(
+                        lambda: path(limit), number=number, repeat=args.repeat
+                    )
+                )
+                results[name] = best / number
+                print(f"{limit:>8} rows  {name:<16} "
+                      f"{results[name] * 1000:9.3f} ms")
+            speedup = results["orm + format()"] / results["column rows"]
+            print(f"{limit:>8} rows  speedup {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
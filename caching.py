@@ -0,0 +1,125 @@
+import hashlib
+import os
+import threading
+import time
+from functools import wraps
+from flask import make_response, request, Response
+from compression import accepted_encoding, encoded_etag
+from sqlalchemy import func
+from models import db, table_versions, Category, Question
+
+CATEGORY_CACHE_TTL = float(os.getenv("CATEGORY_CACHE_TTL", 300))
+
+"""
+conditional(*tables)
+    decorator for GET routes whose response only depends on the request
+    URL and the content of the given tables
+    it emits a strong ETag derived from the URL and the table versions,
+    and answers 304 Not Modified, without running the route, when the
+    client sends it back in If-None-Match (as is, or with the encoding
+    appended by compression.compress_response)
+"""
+
+
+def response_etag(tables):
+    versions = ",".join(
+        f"{name}:{table_versions.get(name)}" for name in tables
+    )
+    key = f"{request.full_path}|{versions}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = response_etag(tables)
+            encoding = accepted_encoding()
+            # The client may hold the compressed representation
+            for candidate in (etag, encoding and encoded_etag(etag, encoding)):
+                if candidate and candidate in request.if_none_match:
+                    response = Response(status=304)
+                    response.set_etag(candidate)
+                    response.vary.add("Accept-Encoding")
+                    return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return wrapper
+
+    return conditional_decorator
+
+
+"""
+CategoryCatalog
+    per-process cache of the categories (id -> type) and of the number of
+    questions per category (id -> count, from the counters maintained in
+    the categories table, see models.adjust_question_counts; None -> count
+    for the questions without a category, when there are any)
+    each part is reloaded when the version of the table it comes from
+    changes, so writes invalidate it (see models.commit_changes), and at
+    least every CATEGORY_CACHE_TTL seconds
+"""
+
+
+class CategoryCatalog:
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def types(self):
+        return self._get("categories", self._load_types)
+
+    def counts(self):
+        return self._get("questions", self._load_counts)
+
+    def exists(self, category_id):
+        return category_id in self.types()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, table, loader):
+        version = table_versions.get(table)
+        entry = self._entries.get(table)
+        if self._fresh(entry, version):
+            return entry[0]
+        with self._lock:
+            entry = self._entries.get(table)
+            if not self._fresh(entry, version):
+                entry = (loader(), version, time.monotonic())
+                self._entries[table] = entry
+        return entry[0]
+
+    def _fresh(self, entry, version):
+        return (
+            entry is not None
+            and entry[1] == version
+            and time.monotonic() - entry[2] < self.ttl
+        )
+
+    def _load_types(self):
+        categories = Category.query.order_by(Category.id).all()
+        return {category.id: category.type for category in categories}
+
+    def _load_counts(self):
+        counts = dict(
+            db.session.query(Category.id, Category.question_count).all()
+        )
+        # Not counted by the categories, read from ix_questions_category_id
+        uncategorized = (
+            db.session.query(func.count(Question.id))
+            .filter(Question.category.is_(None))
+            .scalar()
+        )
+        if uncategorized:
+            counts[None] = uncategorized
+        return counts
+
+
+category_catalog = CategoryCatalog()
@@ -0,0 +1,136 @@
+import os
+import time
+import zlib
+from flask import request
+from profiling import record_timing
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, only gzip is offered without it
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 512))
+# Low levels: most of the size reduction of JSON for a fraction of the CPU
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 4))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 4))
+COMPRESSIBLE_MIMETYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/ndjson",
+    "text/csv",
+    "text/plain",
+    "text/html",
+)
+
+"""
+Response compression, negotiated with the Accept-Encoding request header.
+    brotli (when the brotli package is installed) or gzip, for JSON, NDJSON
+    and text responses of at least COMPRESS_MIN_SIZE bytes
+    streamed responses (i.e. the exports) are compressed chunk by chunk,
+    each chunk being flushed so the client gets the rows as they're read
+    the ETag of a compressed response gets the encoding appended, a strong
+    ETag must differ between representations (see caching.conditional)
+"""
+
+
+def encodings():
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def accepted_encoding():
+    return request.accept_encodings.best_match(encodings())
+
+
+def encoded_etag(etag, encoding):
+    return f"{etag}-{encoding}"
+
+
+class Compressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(
+                quality=COMPRESS_BROTLI_QUALITY
+            )
+        else:
+            self._compressor = zlib.compressobj(
+                COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(data, encoding):
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(chunks, encoding):
+    compressor = Compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compressible(response):
+    return (
+        200 <= response.status_code < 300
+        and response.status_code not in (204, 206)
+        and not response.direct_passthrough
+        and "Content-Encoding" not in response.headers
+        and response.mimetype in COMPRESSIBLE_MIMETYPES
+    )
+
+
+def compress_response(response):
+    if not compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    if (
+        not response.is_streamed
+        and response.calculate_content_length() < COMPRESS_MIN_SIZE
+    ):
+        return response
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        started = time.perf_counter()
+        response.set_data(compress(response.get_data(), encoding))
+        record_timing("compress", time.perf_counter() - started)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
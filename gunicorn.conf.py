@@ -0,0 +1,83 @@
+"""
+gunicorn settings, read by default by `gunicorn app:app` (see Procfile)
+
+With GUNICORN_PRELOAD=true (the default) the app is loaded once in the
+master process and the caches (JWKS, categories) are warmed there before
+the workers are forked; each worker then drops the database connections
+inherited from the master. Without preload every worker warms its own
+caches before accepting requests.
+
+With GUNICORN_WORKER_CLASS=gevent each worker serves up to
+GUNICORN_WORKER_CONNECTIONS concurrent requests: the standard library
+(sockets, so the JWKS fetch, and thread locks) is made cooperative by
+gunicorn and psycopg2 by psycogreen, so a request waiting on Auth0 or the
+database doesn't block the others. The app is then never preloaded, its
+modules must be imported after the monkey patching. Size DB_POOL_SIZE and
+DB_MAX_OVERFLOW for the number of concurrent requests.
+
+The workers share their Prometheus metrics through the files of
+prometheus_multiproc_dir (a new temporary directory by default), which is
+emptied when gunicorn starts. Likewise the rate limits are shared through
+the RATE_LIMIT_DB SQLite database.
+"""
+import glob
+import os
+import tempfile
+from importlib.util import find_spec
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+preload_app = (
+    os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+    and worker_class != "gevent"
+)
+
+os.environ.setdefault(
+    "prometheus_multiproc_dir", tempfile.mkdtemp(prefix="trivia-metrics-")
+)
+# Rate limit buckets shared by the workers (see auth.RateLimiter)
+os.environ.setdefault(
+    "RATE_LIMIT_DB",
+    os.path.join(tempfile.mkdtemp(prefix="trivia-rate-limits-"), "buckets.db"),
+)
+
+
+def on_starting(server):
+    for path in glob.glob(
+        os.path.join(os.environ["prometheus_multiproc_dir"], "*.db")
+    ):
+        os.remove(path)
+
+
+def when_ready(server):
+    if preload_app:
+        from app import app, warm_up
+        from models import dispose_engines
+
+        warm_up(app)
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    if worker_class == "gevent" and find_spec("psycopg2"):
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+    if preload_app:
+        from app import app
+        from models import dispose_engines
+
+        dispose_engines(app)
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        from app import app, warm_up
+
+        warm_up(app)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
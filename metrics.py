@@ -0,0 +1,176 @@
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+"""
+Prometheus metrics, exposed on GET /metrics.
+    under gunicorn every worker writes its samples to the directory named
+    by the prometheus_multiproc_dir environment variable (set up by
+    gunicorn.conf.py) and /metrics adds up the samples of all the workers;
+    without it (e.g. flask run) the metrics are those of the process
+"""
+
+REQUEST_LATENCY = Histogram(
+    "trivia_request_duration_seconds",
+    "Time spent handling a request",
+    ["method", "route"],
+)
+REQUESTS = Counter(
+    "trivia_requests_total",
+    "Requests handled, by response status",
+    ["method", "route", "status"],
+)
+AUTH_LATENCY = Histogram(
+    "trivia_auth_duration_seconds",
+    "Time spent in requires_auth (token validation and permissions)",
+    ["permission"],
+)
+AUTH_ERRORS = Counter(
+    "trivia_auth_errors_total",
+    "Requests rejected by requires_auth, by AuthError code",
+    ["code", "status"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "trivia_db_query_duration_seconds",
+    "Time spent executing a SQL statement",
+)
+REQUEST_QUERIES = Histogram(
+    "trivia_request_db_queries",
+    "SQL statements executed per request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "trivia_db_pool_connections",
+    "Database connections opened by the connection pools",
+    multiprocess_mode="livesum",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "trivia_db_pool_checked_out",
+    "Database connections currently checked out of the connection pools",
+    multiprocess_mode="livesum",
+)
+
+
+def multiprocess_dir():
+    return os.getenv("prometheus_multiproc_dir")
+
+
+def route_label():
+    if request.url_rule is None:
+        return "<unmatched>"
+    return request.url_rule.rule
+
+
+"""
+SQLAlchemy instrumentation, for every engine (primary and replica).
+    statements are timed from before to after cursor execution, and
+    counted per request when they run within one
+"""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info["query_start"].pop()
+    DB_QUERY_LATENCY.observe(time.perf_counter() - started)
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(exception_context):
+    starts = exception_context.connection.info.get("query_start")
+    if starts:
+        starts.pop()
+
+
+@event.listens_for(Pool, "connect")
+def pool_connect(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.inc()
+
+
+@event.listens_for(Pool, "close")
+def pool_close(dbapi_connection, connection_record):
+    DB_POOL_CONNECTIONS.dec()
+
+
+@event.listens_for(Pool, "close_detached")
+def pool_close_detached(dbapi_connection):
+    DB_POOL_CONNECTIONS.dec()
+
+
+@event.listens_for(Pool, "checkout")
+def pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, "checkin")
+def pool_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+"""
+observe_auth(permission, seconds, error)
+    records a requires_auth call, error being the AuthError it raised
+"""
+
+
+def observe_auth(permission, seconds, error=None):
+    AUTH_LATENCY.labels(permission).observe(seconds)
+    if error is not None:
+        AUTH_ERRORS.labels(error.error["code"], error.status_code).inc()
+
+
+"""
+init_metrics(app)
+    times and counts the requests of the app and adds the /metrics route
+"""
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_request_metrics():
+        g.request_started = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if "request_started" not in g:
+            return response
+        route = route_label()
+        REQUEST_LATENCY.labels(request.method, route).observe(
+            time.perf_counter() - g.request_started
+        )
+        REQUESTS.labels(request.method, route, response.status_code).inc()
+        REQUEST_QUERIES.labels(route).observe(g.db_queries)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        registry = REGISTRY
+        if multiprocess_dir():
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(
+            generate_latest(registry), content_type=CONTENT_TYPE_LATEST
+        )
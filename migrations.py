@@ -1,8 +1,12 @@
+import os
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
-from models import db
+# The schema is managed by the migrations, don't create the tables on import
+os.environ.setdefault("DB_CREATE_ALL", "false")
+
+from app import app  # noqa: E402
+from models import db, reconcile_question_counts  # noqa: E402
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,15 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def reconcile_counts():
+    """Recount the questions of every category and fix the counters"""
+    drift = reconcile_question_counts()
+    for category, (counter, count) in sorted(drift.items()):
+        print(f'Category {category}: counter was {counter}, {count} questions')
+    if not drift:
+        print('All the question counters are right')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,45 @@
+"""initial schema
+
+Revision ID: 0b7d2e4c9a61
+Revises:
+Create Date: 2026-10-17 09:58:20.614309
+
+The categories and questions tables as the app first created them (with
+db.create_all), questions.category still being a varchar. Databases
+created that way already have them, the tables are then left as they are.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7d2e4c9a61'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    if 'categories' not in existing:
+        op.create_table(
+            'categories',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('type', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'questions' not in existing:
+        op.create_table(
+            'questions',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('question', sa.String(), nullable=True),
+            sa.Column('answer', sa.String(), nullable=True),
+            sa.Column('category', sa.String(), nullable=True),
+            sa.Column('difficulty', sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('questions')
+    op.drop_table('categories')
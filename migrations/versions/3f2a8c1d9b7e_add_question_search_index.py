@@ -0,0 +1,70 @@
+"""add question full-text search index
+
+Revision ID: 3f2a8c1d9b7e
+Revises: 0b7d2e4c9a61
+Create Date: 2026-10-17 10:12:41.532187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a8c1d9b7e'
+down_revision = '0b7d2e4c9a61'
+branch_labels = None
+depends_on = None
+
+PG_SEARCH_VECTOR = (
+    "to_tsvector('english', "
+    "coalesce(question, '') || ' ' || coalesce(answer, ''))"
+)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_questions_search "
+            f"ON questions USING GIN ({PG_SEARCH_VECTOR})"
+        )
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5("
+            "question, answer, content='questions', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS questions_fts_insert "
+            "AFTER INSERT ON questions BEGIN "
+            "INSERT INTO questions_fts(rowid, question, answer) "
+            "VALUES (new.id, new.question, new.answer); END"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS questions_fts_delete "
+            "AFTER DELETE ON questions BEGIN "
+            "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+            "VALUES ('delete', old.id, old.question, old.answer); END"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS questions_fts_update "
+            "AFTER UPDATE ON questions BEGIN "
+            "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+            "VALUES ('delete', old.id, old.question, old.answer); "
+            "INSERT INTO questions_fts(rowid, question, answer) "
+            "VALUES (new.id, new.question, new.answer); END"
+        )
+        op.execute(
+            "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"
+        )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_questions_search")
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS questions_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS questions_fts_delete")
+        op.execute("DROP TRIGGER IF EXISTS questions_fts_insert")
+        op.execute("DROP TABLE IF EXISTS questions_fts")
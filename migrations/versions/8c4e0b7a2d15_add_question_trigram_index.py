@@ -0,0 +1,38 @@
+"""add question trigram index
+
+Revision ID: 8c4e0b7a2d15
+Revises: 3f2a8c1d9b7e
+Create Date: 2026-10-17 11:40:08.271953
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e0b7a2d15'
+down_revision = '3f2a8c1d9b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("""
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_questions_question_trgm
+        ON questions USING GIN (question gin_trgm_ops);
+EXCEPTION WHEN insufficient_privilege OR undefined_file THEN
+    RAISE NOTICE 'pg_trgm is not available, substring search is not indexed';
+END
+$$
+""")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("DROP INDEX IF EXISTS ix_questions_question_trgm")
@@ -0,0 +1,37 @@
+"""add category question count
+
+Revision ID: a9d36e71b2f4
+Revises: e4b92f06c1d8
+Create Date: 2026-10-17 19:12:08.527316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d36e71b2f4'
+down_revision = 'e4b92f06c1d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'categories',
+        sa.Column('question_count', sa.Integer(), nullable=False,
+                  server_default='0')
+    )
+    op.execute(
+        'UPDATE categories SET question_count = ('
+        'SELECT count(*) FROM questions '
+        'WHERE questions.category = categories.id)'
+    )
+    op.execute(
+        "UPDATE table_versions SET version = version + 1 "
+        "WHERE name = 'questions'"
+    )
+
+
+def downgrade():
+    op.drop_column('categories', 'question_count')
@@ -0,0 +1,146 @@
+"""question category integer foreign key
+
+Revision ID: b51d7e93a0c4
+Revises: 8c4e0b7a2d15
+Create Date: 2026-10-17 14:03:52.904416
+
+questions.category goes from a varchar holding the category id to an
+integer foreign key to categories.id, indexed together with the question id.
+
+On PostgreSQL the migration runs online: the new column is added empty,
+filled in batches of BACKFILL_BATCH_SIZE rows (each batch committed on its
+own, so no long lock is held), indexed concurrently, and only then swapped
+with the old column in a short transaction that also catches up the rows
+written or changed in the meantime. Values that don't match an existing
+category are set to NULL. The foreign key is added NOT VALID in that
+transaction and validated after it, without blocking writes.
+
+SQLite needs 3.35 or later (ALTER TABLE ... DROP COLUMN).
+"""
+import os
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b51d7e93a0c4'
+down_revision = '8c4e0b7a2d15'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 5000))
+
+BATCH_UPPER_ID = """
+SELECT max(id) FROM (
+    SELECT id FROM questions WHERE id > :last_id ORDER BY id LIMIT :batch_size
+) AS batch
+"""
+
+BACKFILL = """
+UPDATE questions SET category_id = categories.id
+FROM categories
+WHERE questions.id > :last_id AND questions.id <= :upper_id
+AND categories.id::text = questions.category
+"""
+
+CATCH_UP = """
+UPDATE questions SET category_id = categories.id
+FROM categories
+WHERE categories.id::text = questions.category
+AND questions.category_id IS DISTINCT FROM categories.id
+"""
+
+CATCH_UP_UNMATCHED = """
+UPDATE questions SET category_id = NULL
+WHERE category_id IS NOT NULL
+AND NOT EXISTS (
+    SELECT 1 FROM categories WHERE categories.id::text = questions.category
+)
+"""
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        upgrade_postgresql()
+    else:
+        upgrade_sqlite()
+
+
+def upgrade_postgresql():
+    bind = op.get_bind()
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TABLE questions ADD COLUMN category_id integer")
+        last_id = 0
+        while True:
+            upper_id = bind.execute(
+                sa.text(BATCH_UPPER_ID),
+                last_id=last_id,
+                batch_size=BACKFILL_BATCH_SIZE,
+            ).scalar()
+            if upper_id is None:
+                break
+            bind.execute(sa.text(BACKFILL), last_id=last_id, upper_id=upper_id)
+            last_id = upper_id
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_category_id "
+            "ON questions (category_id, id)"
+        )
+    # Catch up rows inserted or updated during the backfill (including
+    # rows of batches already done), then swap the columns
+    op.execute("LOCK TABLE questions IN SHARE ROW EXCLUSIVE MODE")
+    op.execute(sa.text(CATCH_UP))
+    op.execute(sa.text(CATCH_UP_UNMATCHED))
+    op.drop_column('questions', 'category')
+    op.alter_column('questions', 'category_id', new_column_name='category')
+    op.execute(
+        "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+        "FOREIGN KEY (category) REFERENCES categories (id) NOT VALID"
+    )
+    # Commits the swap first, validating only needs a SHARE UPDATE
+    # EXCLUSIVE lock, which lets reads and writes through
+    with op.get_context().autocommit_block():
+        op.execute(
+            "ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey"
+        )
+
+
+def upgrade_sqlite():
+    op.execute(
+        "ALTER TABLE questions "
+        "ADD COLUMN category_id INTEGER REFERENCES categories (id)"
+    )
+    op.execute(
+        "UPDATE questions SET category_id = ("
+        "SELECT id FROM categories "
+        "WHERE CAST(categories.id AS TEXT) = questions.category)"
+    )
+    op.execute("ALTER TABLE questions DROP COLUMN category")
+    op.execute(
+        "ALTER TABLE questions RENAME COLUMN category_id TO category"
+    )
+    op.create_index(
+        'ix_questions_category_id', 'questions', ['category', 'id']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_questions_category_id', table_name='questions')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint(
+            'questions_category_fkey', 'questions', type_='foreignkey'
+        )
+        op.alter_column(
+            'questions',
+            'category',
+            type_=sa.String(),
+            postgresql_using='category::text',
+        )
+    else:
+        op.execute("ALTER TABLE questions ADD COLUMN category_text VARCHAR")
+        op.execute(
+            "UPDATE questions SET category_text = CAST(category AS TEXT)"
+        )
+        op.execute("ALTER TABLE questions DROP COLUMN category")
+        op.execute(
+            "ALTER TABLE questions RENAME COLUMN category_text TO category"
+        )
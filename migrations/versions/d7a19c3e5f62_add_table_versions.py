@@ -0,0 +1,36 @@
+"""add table versions
+
+Revision ID: d7a19c3e5f62
+Revises: b51d7e93a0c4
+Create Date: 2026-10-17 16:21:37.118630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a19c3e5f62'
+down_revision = 'b51d7e93a0c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(
+        table_versions,
+        [
+            {'name': 'questions', 'version': 1},
+            {'name': 'categories', 'version': 1},
+        ]
+    )
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,37 @@
+"""add quiz sessions
+
+Revision ID: e4b92f06c1d8
+Revises: d7a19c3e5f62
+Create Date: 2026-10-17 18:04:52.310947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b92f06c1d8'
+down_revision = 'd7a19c3e5f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'quiz_sessions',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('subject', sa.String(), nullable=False),
+        sa.Column('category', sa.Integer(), nullable=True),
+        sa.Column('seen', sa.LargeBinary(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['category'], ['categories.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_quiz_sessions_expires_at'), 'quiz_sessions',
+                    ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_quiz_sessions_expires_at'),
+                  table_name='quiz_sessions')
+    op.drop_table('quiz_sessions')
@@ -0,0 +1,152 @@
+"""
+Local signing keys and tokens, to run the API (and its benchmarks and
+load tests) without Auth0.
+
+    python mint_token.py keygen keys/
+    export JWKS_FILE=keys/jwks.json
+    python mint_token.py token --key keys/private.pem --role admin
+
+(AUTH_PUBLIC_KEY="$(cat keys/public.pem)" works as well as JWKS_FILE.)
+
+keygen writes a new RSA key pair as private.pem, public.pem and jwks.json.
+token prints a token signed with the private key, carrying the permissions
+of the role (or of --permission) and issued for AUTH0_DOMAIN and
+API_AUDIENCE, as the API expects.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jose.utils import long_to_base64
+
+DEFAULT_KID = "local"
+ROLES = {
+    "player": ["get:categories", "get:quizzes"],
+    "qa": ["get:categories", "get:questions"],
+    "admin": [
+        "get:categories",
+        "get:questions",
+        "get:quizzes",
+        "create:questions",
+        "update:questions",
+        "delete:questions",
+    ],
+}
+
+
+def generate_key(bits=2048):
+    return RSA.generate(bits)
+
+
+def public_jwks(key, kid=DEFAULT_KID):
+    return {
+        "keys": [
+            {
+                "kty": "RSA",
+                "kid": kid,
+                "use": "sig",
+                "alg": "RS256",
+                "n": long_to_base64(key.n).decode("utf-8"),
+                "e": long_to_base64(key.e).decode("utf-8"),
+            }
+        ]
+    }
+
+
+"""
+mint(private_pem, permissions, ...)
+    returns an RS256 token with the claims verify_decode_jwt checks
+"""
+
+
+def mint(
+    private_pem,
+    permissions,
+    subject="local|user",
+    expires_in=3600,
+    kid=DEFAULT_KID,
+    domain=None,
+    audience=None,
+):
+    now = int(time.time())
+    claims = {
+        "iss": f"https://{domain or os.getenv('AUTH0_DOMAIN')}/",
+        "aud": audience or os.getenv("API_AUDIENCE"),
+        "sub": subject,
+        "iat": now,
+        "exp": now + expires_in,
+        "permissions": list(permissions),
+    }
+    return jwt.encode(
+        claims, private_pem, algorithm="RS256", headers={"kid": kid}
+    )
+
+
+def keygen(args):
+    key = generate_key(args.bits)
+    os.makedirs(args.directory, exist_ok=True)
+    private_path = os.path.join(args.directory, "private.pem")
+    with open(os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      0o600), "wb") as private_file:
+        private_file.write(key.exportKey("PEM"))
+    with open(os.path.join(args.directory, "public.pem"), "wb") as pem:
+        pem.write(key.publickey().exportKey("PEM"))
+    with open(os.path.join(args.directory, "jwks.json"), "w") as jwks:
+        json.dump(public_jwks(key, args.kid), jwks, indent=2)
+    print(f"Keys written to {args.directory}")
+
+
+def token(args):
+    if not (args.domain or os.getenv("AUTH0_DOMAIN")) or not (
+        args.audience or os.getenv("API_AUDIENCE")
+    ):
+        sys.exit("Set AUTH0_DOMAIN and API_AUDIENCE (or --domain/--audience)")
+    with open(args.key) as private_file:
+        private_pem = private_file.read()
+    permissions = args.permission or ROLES[args.role]
+    print(
+        mint(
+            private_pem,
+            permissions,
+            subject=args.sub,
+            expires_in=args.expires_in,
+            kid=args.kid,
+            domain=args.domain,
+            audience=args.audience,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    keygen_parser = commands.add_parser("keygen", help="create a key pair")
+    keygen_parser.add_argument("directory")
+    keygen_parser.add_argument("--kid", default=DEFAULT_KID)
+    keygen_parser.add_argument("--bits", type=int, default=2048)
+    keygen_parser.set_defaults(run=keygen)
+
+    token_parser = commands.add_parser("token", help="mint a token")
+    token_parser.add_argument("--key", required=True,
+                              help="private key (PEM)")
+    token_parser.add_argument("--role", choices=sorted(ROLES),
+                              default="player")
+    token_parser.add_argument("--permission", action="append",
+                              help="overrides the permissions of the role")
+    token_parser.add_argument("--sub", default="local|user")
+    token_parser.add_argument("--expires-in", type=int, default=3600)
+    token_parser.add_argument("--kid", default=DEFAULT_KID)
+    token_parser.add_argument("--domain")
+    token_parser.add_argument("--audience")
+    token_parser.set_defaults(run=token)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
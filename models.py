@@ -1,23 +1,180 @@
+import csv
+import io
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+import random
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy import (DDL, Column, DateTime, String, Integer, ForeignKey,
+                        Index, LargeBinary, event, func, orm, text)
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
 
 database_path = os.getenv("DATABASE_URL")
+replica_path = os.getenv("DATABASE_REPLICA_URL")
+TABLE_VERSION_TTL = float(os.getenv("TABLE_VERSION_TTL", 1))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+# Set to false in production, where the schema is managed by the migrations
+DB_CREATE_ALL = os.getenv("DB_CREATE_ALL", "true").lower() == "true"
+QUIZ_SESSION_TTL = int(os.getenv("QUIZ_SESSION_TTL", 3600))
+QUIZ_SCAN_BATCH = 50
+# Seen sets up to this size are excluded by the database (NOT IN)
+QUIZ_SQL_EXCLUDE_MAX = 100
+
+"""
+Read replica routing
+    when DATABASE_REPLICA_URL is set, queries made while handling a route
+    decorated with @read_replica go to the replica, everything else
+    (and any flush) goes to the primary
+    the replica is only used while it's reachable and lagging less than
+    REPLICA_MAX_LAG seconds behind the primary, checked at most every
+    REPLICA_CHECK_INTERVAL seconds; otherwise reads fall back to the primary
+"""
+
+
+class ReplicaHealth:
+    def __init__(self, max_lag=REPLICA_MAX_LAG,
+                 interval=REPLICA_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.interval = interval
+        self._usable = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def usable(self, engine):
+        with self._lock:
+            if self._checked_at is None or (
+                time.monotonic() - self._checked_at >= self.interval
+            ):
+                self._usable = self._check(engine)
+                self._checked_at = time.monotonic()
+            return self._usable
+
+    def _check(self, engine):
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name != "postgresql":
+                    connection.execute("SELECT 1")
+                    return True
+                lag = connection.execute(
+                    "SELECT CASE WHEN pg_is_in_recovery() THEN "
+                    "coalesce(extract(epoch FROM now() - "
+                    "pg_last_xact_replay_timestamp()), 0) ELSE 0 END"
+                ).scalar()
+        except Exception:
+            return False
+        return lag <= self.max_lag
+
+
+replica_health = ReplicaHealth()
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and use_replica(self.app):
+            replica = self.db.get_engine(self.app, bind="replica")
+            if replica_health.usable(replica):
+                return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def use_replica(app):
+    return (
+        has_request_context()
+        and g.get("read_replica", False)
+        and "replica" in app.config["SQLALCHEMY_BINDS"]
+    )
+
+
+def read_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+db = RoutingSQLAlchemy()
+
+"""
+engine_options(database_path)
+    connection pool and statement timeout settings, from the environment
+"""
+
+
+def engine_options(database_path):
+    if not database_path or database_path.startswith("sqlite"):
+        return {}
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT and database_path.startswith("postgres"):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+        }
+    return options
 
-db = SQLAlchemy()
 
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    replica_path is the optional read-only replica (see read_replica)
+    the tables are only created when create_all is set (DB_CREATE_ALL)
 """
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_path=replica_path,
+             create_all=DB_CREATE_ALL):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    app.config["SQLALCHEMY_BINDS"] = (
+        {"replica": replica_path} if replica_path else {}
+    )
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if create_all:
+        db.create_all(bind=None)
+
+
+"""
+dispose_engines(app)
+    closes the pooled connections of every engine of the app, to be called
+    in a forked worker so it doesn't share the parent's connections
+"""
+
+
+def dispose_engines(app):
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+        for bind in app.config["SQLALCHEMY_BINDS"]:
+            db.get_engine(app, bind=bind).dispose()
 
 
 """
@@ -28,11 +185,13 @@ Question
 
 class Question(db.Model):
     __tablename__ = "questions"
+    # Serves both the category filter and the pagination by id within it
+    __table_args__ = (Index("ix_questions_category_id", "category", "id"),)
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey("categories.id"))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -43,14 +202,154 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_changes("questions")
 
     def update(self):
-        db.session.commit()
+        commit_changes("questions")
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_changes("questions")
+
+    """
+    pick_random(category, exclude)
+        returns a random question of the category (any category if None)
+        whose id is not in exclude, or None when there are none left.
+        A random id is drawn between the lowest and highest eligible ids and
+        the first eligible question from there is returned, so only the
+        primary key index is used instead of sorting the table by random().
+    """
+
+    @classmethod
+    def pick_random(cls, category=None, exclude=()):
+        query = cls.query
+        if category:
+            query = query.filter(cls.category == category)
+        if exclude:
+            query = query.filter(~cls.id.in_(exclude))
+        low, high = query.with_entities(func.min(cls.id),
+                                        func.max(cls.id)).first()
+        if low is None:
+            return None
+        pivot = random.randint(low, high)
+        return query.filter(cls.id >= pivot).order_by(cls.id).first()
+
+    """
+    pick_unseen(category, seen, total)
+        same as pick_random, with seen a set of ids.
+        Small seen sets are excluded by the database. Larger ones are
+        checked in Python instead of being sent with every query: questions
+        are read by primary key from the random id onwards,
+        QUIZ_SCAN_BATCH at a time, wrapping around to the lowest id, until
+        one is not in seen.
+        total, the number of questions of the category (or of all of them)
+        when known, avoids that scan reading the whole category when seen
+        looks like it covers it: the database then excludes seen in a single
+        query. total is only a hint, seen may hold questions deleted since
+        and cached counts may be late.
+    """
+
+    @classmethod
+    def pick_unseen(cls, category=None, seen=frozenset(), total=None):
+        if len(seen) <= QUIZ_SQL_EXCLUDE_MAX or (
+            total is not None and len(seen) >= total
+        ):
+            return cls.pick_random(category, list(seen))
+        query = cls.query
+        if category:
+            query = query.filter(cls.category == category)
+        low, high = query.with_entities(func.min(cls.id),
+                                        func.max(cls.id)).first()
+        if low is None:
+            return None
+        pivot = random.randint(low, high)
+        # From the pivot to the highest id, then from the lowest to the pivot
+        for after, before in ((pivot - 1, None), (low - 1, pivot)):
+            while True:
+                batch = query.filter(cls.id > after)
+                if before is not None:
+                    batch = batch.filter(cls.id < before)
+                batch = batch.order_by(cls.id).limit(QUIZ_SCAN_BATCH).all()
+                for question in batch:
+                    if question.id not in seen:
+                        return question
+                if len(batch) < QUIZ_SCAN_BATCH:
+                    break
+                after = batch[-1].id
+        return None
+
+    """
+    bulk_insert(rows)
+        inserts a batch of questions, given as dicts with the question,
+        answer, category and difficulty keys, in a single transaction
+        and returns their ids in the same order.
+        On PostgreSQL the ids are reserved from the sequence and the rows
+        are loaded with COPY, otherwise a bulk INSERT is used.
+    """
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        if not rows:
+            return []
+        if db.session.get_bind().dialect.name == "postgresql":
+            ids = cls._copy_rows(rows)
+        else:
+            db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+            ids = [row["id"] for row in rows]
+        # Bulk inserts skip the flush, count them here
+        adjust_question_counts(
+            db.session, Counter(row["category"] for row in rows)
+        )
+        commit_changes("questions")
+        return ids
+
+    @classmethod
+    def _copy_rows(cls, rows):
+        connection = db.session.connection()
+        ids = [
+            id
+            for (id,) in connection.execute(
+                text(
+                    "SELECT nextval(pg_get_serial_sequence('questions', 'id'))"
+                    " FROM generate_series(1, :count)"
+                ),
+                count=len(rows),
+            )
+        ]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for id, row in zip(ids, rows):
+            writer.writerow(
+                [
+                    id,
+                    row["question"],
+                    row["answer"],
+                    row["category"],
+                    row["difficulty"],
+                ]
+            )
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            "COPY questions (id, question, answer, category, difficulty) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        return ids
+
+    """
+    select_rows()
+        query returning plain (id, question, answer, category, difficulty)
+        tuples instead of Question instances, for listings and exports
+        where building ORM objects only to call format() dominates the cost;
+        use format_rows() to turn its results into response dicts
+    """
+
+    @classmethod
+    def select_rows(cls):
+        return db.session.query(
+            cls.id, cls.question, cls.answer, cls.category, cls.difficulty
+        )
 
     def format(self):
         return {
@@ -62,6 +361,13 @@ class Question(db.Model):
         }
 
 
+QUESTION_FIELDS = ("id", "question", "answer", "category", "difficulty")
+
+
+def format_rows(rows):
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
 """
 Category
 
@@ -73,9 +379,271 @@ class Category(db.Model):
 
     id = Column(Integer, primary_key=True)
     type = Column(String)
+    # Maintained by count_question_changes and Question.bulk_insert
+    question_count = Column(Integer, nullable=False, default=0,
+                            server_default="0")
 
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        commit_changes("categories")
+
+    def update(self):
+        commit_changes("categories")
+
+    def delete(self):
+        db.session.delete(self)
+        commit_changes("categories")
+
     def format(self):
         return {"id": self.id, "type": self.type}
+
+
+"""
+Question counters
+    categories.question_count holds the number of questions of the category,
+    updated in the transaction of every write to the questions: the changes
+    made through the ORM are counted before each flush, Question.bulk_insert
+    counts its rows itself; questions without a category (left by the
+    migration to an integer category) are counted separately, see
+    caching.CategoryCatalog
+    writes that bypass both (SQL run by hand, Core inserts) leave the
+    counters off until reconcile_question_counts() recounts them, see the
+    reconcile_counts command of migrations.py
+"""
+
+
+def adjust_question_counts(session, deltas):
+    # In a stable order, so concurrent writers lock the rows in the same order
+    for category in sorted(deltas, key=str):
+        if category is None or not deltas[category]:
+            continue
+        session.execute(
+            Category.__table__.update()
+            .where(Category.id == category)
+            .values(question_count=Category.question_count
+                    + deltas[category])
+        )
+
+
+def committed_category(question):
+    history = orm.attributes.get_history(question, "category")
+    return history.deleted[0] if history.deleted else question.category
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def count_question_changes(session, flush_context, instances):
+    deltas = Counter()
+    for question in session.new:
+        if isinstance(question, Question):
+            deltas[question.category] += 1
+    for question in session.deleted:
+        if isinstance(question, Question):
+            deltas[committed_category(question)] -= 1
+    for question in session.dirty:
+        if isinstance(question, Question):
+            previous = committed_category(question)
+            if previous != question.category:
+                deltas[previous] -= 1
+                deltas[question.category] += 1
+    adjust_question_counts(session, deltas)
+
+
+"""
+reconcile_question_counts()
+    recounts the questions of every category and fixes the counters that
+    drifted, returns them as {category id: (counter, actual count)}
+    the categories are locked before counting, so writes running meanwhile
+    are either counted or adjust the counter after the fix
+"""
+
+
+def reconcile_question_counts():
+    categories = Category.query.order_by(Category.id).with_for_update().all()
+    actual = dict(
+        db.session.query(Question.category, func.count(Question.id))
+        .group_by(Question.category)
+        .all()
+    )
+    drift = {}
+    for category in categories:
+        count = actual.get(category.id, 0)
+        if category.question_count != count:
+            drift[category.id] = (category.question_count, count)
+            category.question_count = count
+    commit_changes("questions")
+    return drift
+
+
+"""
+QuizSession
+    a quiz played server-side: the category played (None for all of them)
+    and the ids of the questions already asked, stored as a packed array of
+    unsigned 32-bit integers (4 bytes per question) and loaded into a set
+    for the exclusion checks
+    a session expires QUIZ_SESSION_TTL seconds after its last turn
+"""
+
+
+class QuizSession(db.Model):
+    __tablename__ = "quiz_sessions"
+
+    id = Column(String(32), primary_key=True)
+    subject = Column(String, nullable=False)
+    category = Column(Integer, ForeignKey("categories.id"))
+    seen = Column(LargeBinary, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, subject, category=None):
+        self.id = uuid.uuid4().hex
+        self.subject = subject
+        self.category = category
+        self.seen = b""
+        self.touch()
+
+    def touch(self):
+        self.expires_at = datetime.utcnow() + timedelta(
+            seconds=QUIZ_SESSION_TTL
+        )
+
+    def seen_ids(self):
+        ids = array("I")
+        ids.frombytes(self.seen)
+        return ids
+
+    """
+    start(subject, category)
+        creates a session for the subject, deleting the expired ones
+    """
+
+    @classmethod
+    def start(cls, subject, category=None):
+        cls.query.filter(cls.expires_at <= datetime.utcnow()).delete(
+            synchronize_session=False
+        )
+        session = cls(subject, category)
+        db.session.add(session)
+        db.session.commit()
+        return session
+
+    """
+    find(id, subject)
+        returns the session if it belongs to the subject and hasn't expired,
+        locked until the end of the transaction so concurrent turns of the
+        same session are serialized
+    """
+
+    @classmethod
+    def find(cls, id, subject):
+        return (
+            cls.query.filter(
+                cls.id == id,
+                cls.subject == subject,
+                cls.expires_at > datetime.utcnow(),
+            )
+            .with_for_update()
+            .first()
+        )
+
+    """
+    next_question(total)
+        picks a question the session hasn't seen yet (None when all of them
+        were), records it and returns it with the number of questions played
+        total is the number of questions the session can be asked, when
+        known, see Question.pick_unseen
+    """
+
+    def next_question(self, total=None):
+        seen = self.seen_ids()
+        question = Question.pick_unseen(self.category, set(seen), total)
+        if question is not None:
+            seen.append(question.id)
+            self.seen = seen.tobytes()
+        self.touch()
+        db.session.commit()
+        return question, len(seen)
+
+
+"""
+TableVersion
+    a counter per table, bumped in the same transaction as every write to
+    the table (see commit_changes), used to tell whether cached responses
+    are still fresh
+"""
+
+
+class TableVersion(db.Model):
+    __tablename__ = "table_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=1)
+
+
+event.listen(
+    TableVersion.__table__,
+    "after_create",
+    DDL(
+        "INSERT INTO table_versions (name, version) "
+        "VALUES ('questions', 1), ('categories', 1)"
+    ),
+)
+
+"""
+TableVersionCache
+    per-process cache of the table versions
+    versions are read from the database at most once every ttl seconds,
+    which bounds how long other workers can take to notice a write;
+    writes done by this process are noticed right away
+"""
+
+
+class TableVersionCache:
+    def __init__(self, ttl=TABLE_VERSION_TTL):
+        self.ttl = ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        cached = self._versions.get(name)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        version = (
+            db.session.query(TableVersion.version)
+            .filter_by(name=name)
+            .scalar()
+        ) or 0
+        with self._lock:
+            self._versions[name] = (version, time.monotonic())
+        return version
+
+    def invalidate(self, name):
+        with self._lock:
+            self._versions.pop(name, None)
+
+
+table_versions = TableVersionCache()
+
+"""
+commit_changes(*tables)
+    bumps the version of the given tables and commits the session
+"""
+
+
+def bump_version(name):
+    updated = (
+        TableVersion.query.filter_by(name=name)
+        .update({TableVersion.version: TableVersion.version + 1},
+                synchronize_session=False)
+    )
+    if not updated:
+        db.session.add(TableVersion(name=name, version=1))
+
+
+def commit_changes(*tables):
+    for name in tables:
+        bump_version(name)
+    db.session.commit()
+    for name in tables:
+        table_versions.invalidate(name)
@@ -0,0 +1,139 @@
+import os
+import time
+from collections import Counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() == "true"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 3))
+
+"""
+Per-request SQL profiling, enabled with SQL_PROFILING=true.
+    every SQL statement run by a request is recorded with its duration
+    and, once the response is ready:
+    - each statement is logged at debug level
+    - statements slower than SLOW_QUERY_MS are logged as warnings
+    - statements run N_PLUS_ONE_THRESHOLD times or more by the request are
+      logged as N+1 candidates
+    - a Server-Timing header reports the time spent in requires_auth (auth),
+      running SQL statements (db), encoding JSON (serialize), compressing
+      the response (compress, see compression.py) and in total
+"""
+
+
+def profiling():
+    return has_request_context() and "sql_profile" in g
+
+
+"""
+record_timing(name, seconds)
+    adds to the time reported as name in the Server-Timing header of the
+    current request, when it's profiled
+"""
+
+
+def record_timing(name, seconds):
+    if profiling():
+        g.timings[name] = g.timings.get(name, 0) + seconds
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def profile_before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+    if profiling():
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def profile_after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+    starts = conn.info.get("profile_start")
+    if starts and profiling():
+        elapsed = time.perf_counter() - starts.pop()
+        g.sql_profile.append((statement, elapsed))
+        record_timing("db", elapsed)
+
+
+@event.listens_for(Engine, "handle_error")
+def profile_handle_error(exception_context):
+    starts = exception_context.connection.info.get("profile_start")
+    if starts:
+        starts.pop()
+
+
+def server_timing(timings, queries):
+    entries = []
+    for name in ("auth", "db", "serialize", "compress", "total"):
+        if name not in timings:
+            continue
+        entry = f"{name};dur={timings[name] * 1000:.2f}"
+        if name == "db":
+            entry += f';desc="{queries} queries"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+def log_profile(statements):
+    logger = current_app.logger
+    where = f"{request.method} {request.path}"
+    for statement, elapsed in statements:
+        logger.debug("SQL %.2f ms in %s: %s", elapsed * 1000, where, statement)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning(
+                "Slow query (%.2f ms) in %s: %s",
+                elapsed * 1000,
+                where,
+                statement,
+            )
+    repeated = Counter(statement for statement, _ in statements)
+    for statement, count in repeated.items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            logger.warning(
+                "N+1 candidate, run %d times in %s: %s",
+                count,
+                where,
+                statement,
+            )
+
+
+"""
+init_profiling(app)
+    profiles the requests of the app when SQL_PROFILING is enabled, JSON
+    encoding time covers jsonify and serialization.json_response
+"""
+
+
+def init_profiling(app):
+    if not SQL_PROFILING:
+        return
+
+    class TimedJSONEncoder(app.json_encoder):
+        def encode(self, o):
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                record_timing("serialize", time.perf_counter() - started)
+
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_profile():
+        g.profile_started = time.perf_counter()
+        g.sql_profile = []
+        g.timings = {}
+
+    @app.after_request
+    def finish_profile(response):
+        if not profiling():
+            return response
+        g.timings["total"] = time.perf_counter() - g.profile_started
+        g.timings.setdefault("db", 0)
+        log_profile(g.sql_profile)
+        response.headers["Server-Timing"] = server_timing(
+            g.timings, len(g.sql_profile)
+        )
+        response.headers["Timing-Allow-Origin"] = "*"
+        return response
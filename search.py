@@ -0,0 +1,198 @@
+import os
+import re
+from sqlalchemy import DDL, event, func, literal_column, text
+from sqlalchemy.sql import column, table
+from models import db, Question
+
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 1000))
+
+"""
+Trigram index on the question text (PostgreSQL only).
+    lets substring searches (ILIKE '%term%') use an index instead of a
+    sequential scan; when pg_trgm can't be installed the index is skipped
+    and substring searches keep working unindexed
+"""
+
+PG_TRIGRAM_DDL = """
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_questions_question_trgm
+        ON questions USING GIN (question gin_trgm_ops);
+EXCEPTION WHEN insufficient_privilege OR undefined_file THEN
+    RAISE NOTICE 'pg_trgm is not available, substring search is not indexed';
+END
+$$
+"""
+
+"""
+Full-text index over the question and answer text.
+    PostgreSQL: GIN expression index over an english tsvector, kept up to
+    date by PostgreSQL itself
+    SQLite: FTS5 external content table kept in sync with triggers
+The DDL runs after the questions table is created by db.create_all(),
+existing databases get it from the migrations.
+"""
+
+PG_SEARCH_VECTOR = (
+    "to_tsvector('english', "
+    "coalesce(question, '') || ' ' || coalesce(answer, ''))"
+)
+
+PG_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_questions_search "
+    f"ON questions USING GIN ({PG_SEARCH_VECTOR})",
+]
+
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5("
+    "question, answer, content='questions', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS questions_fts_insert "
+    "AFTER INSERT ON questions BEGIN "
+    "INSERT INTO questions_fts(rowid, question, answer) "
+    "VALUES (new.id, new.question, new.answer); END",
+    "CREATE TRIGGER IF NOT EXISTS questions_fts_delete "
+    "AFTER DELETE ON questions BEGIN "
+    "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+    "VALUES ('delete', old.id, old.question, old.answer); END",
+    "CREATE TRIGGER IF NOT EXISTS questions_fts_update "
+    "AFTER UPDATE ON questions BEGIN "
+    "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+    "VALUES ('delete', old.id, old.question, old.answer); "
+    "INSERT INTO questions_fts(rowid, question, answer) "
+    "VALUES (new.id, new.question, new.answer); END",
+    "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')",
+]
+
+
+def sqlite_has_fts5(ddl, target, bind, **kw):
+    options = [row[0] for row in bind.execute("PRAGMA compile_options")]
+    return "ENABLE_FTS5" in options
+
+
+for statement in [PG_TRIGRAM_DDL] + PG_SEARCH_DDL:
+    event.listen(
+        Question.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="postgresql"),
+    )
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(
+        Question.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite", callable_=sqlite_has_fts5),
+    )
+
+questions_fts = table("questions_fts", column("rowid"), column("rank"))
+
+"""
+search_terms(search_term)
+    splits the search term in lowercase words, dropping punctuation
+"""
+
+
+def search_terms(search_term):
+    return re.findall(r"\w+", search_term.lower())
+
+
+def has_fulltext_index():
+    bind = db.session.get_bind()
+    if bind.dialect.name == "postgresql":
+        return True
+    if bind.dialect.name == "sqlite":
+        return bool(
+            bind.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'questions_fts'"
+            ).first()
+        )
+    return False
+
+
+"""
+fulltext_query(search_term)
+    returns a query of question rows (see Question.select_rows) matching
+    every word of the search term as a prefix, ordered by relevance, or
+    None when the database doesn't have a full-text index or the search
+    term has no words
+"""
+
+
+def fulltext_query(search_term):
+    terms = search_terms(search_term)
+    if not terms or not has_fulltext_index():
+        return None
+    if db.session.get_bind().dialect.name == "postgresql":
+        vector = literal_column(PG_SEARCH_VECTOR)
+        tsquery = func.to_tsquery(
+            "english", " & ".join(term + ":*" for term in terms)
+        )
+        return (
+            Question.select_rows()
+            .filter(vector.op("@@")(tsquery))
+            .order_by(func.ts_rank_cd(vector, tsquery).desc(), Question.id)
+        )
+    match = " ".join('"' + term + '"*' for term in terms)
+    return (
+        Question.select_rows()
+        .join(questions_fts, questions_fts.c.rowid == Question.id)
+        .filter(text("questions_fts MATCH :match"))
+        .params(match=match)
+        .order_by(questions_fts.c.rank, Question.id)
+    )
+
+
+"""
+substring_query(search_term)
+    returns a query of the question rows containing the search term,
+    case insensitive; served by the trigram index on PostgreSQL
+"""
+
+
+def escape_like(search_term):
+    return (
+        search_term.replace("\\", "\\\\")
+        .replace("%", "\\%")
+        .replace("_", "\\_")
+    )
+
+
+def substring_query(search_term):
+    return Question.select_rows().filter(
+        Question.question.ilike(
+            "%" + escape_like(search_term) + "%", escape="\\"
+        )
+    ).order_by(Question.id)
+
+
+"""
+search_questions(search_term, page, per_page, mode)
+    returns the requested page of question rows matching the search term
+    and the number of matches, capped at SEARCH_MAX_RESULTS
+    mode "substring" returns the questions containing the search term
+    mode "fulltext" uses the full-text index when available, ranking the
+    results by relevance, and falls back to substring matching otherwise
+"""
+
+SEARCH_MODES = ("substring", "fulltext")
+
+
+def search_questions(search_term, page=1, per_page=10, mode="substring"):
+    query = None
+    if mode == "fulltext":
+        query = fulltext_query(search_term)
+    if query is None:
+        query = substring_query(search_term)
+    capped = (
+        query.with_entities(Question.id)
+        .order_by(None)
+        .limit(SEARCH_MAX_RESULTS)
+    )
+    total = db.session.query(func.count()).select_from(
+        capped.subquery()
+    ).scalar()
+    start = (page - 1) * per_page
+    if page < 1 or start >= total:
+        return [], total
+    limit = min(per_page, SEARCH_MAX_RESULTS - start)
+    return query.offset(start).limit(limit).all(), total
@@ -0,0 +1,30 @@
+import json
+import time
+from flask import current_app
+from profiling import record_timing
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard json module is used
+    orjson = None
+
+"""
+JSON encoding for the listing endpoints.
+    uses orjson when it's installed, which is several times faster than
+    the json module for large payloads, and the json module otherwise
+"""
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(payload, status=200):
+    started = time.perf_counter()
+    body = dumps(payload)
+    record_timing("serialize", time.perf_counter() - started)
+    return current_app.response_class(
+        body, status=status, mimetype="application/json"
+    )